@@ -1,6 +1,117 @@
+import math
+import multiprocessing
 import os
+import tempfile
 
 PORT = os.getenv("PORT", "5000")
 bind = "0.0.0.0:" + PORT
-workers = 1
 log_level = "info"
+
+
+def available_cpus():
+    """ Returns the CPUs this process may use, within a container CPU quota """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = multiprocessing.cpu_count()
+    quota = None
+    try:  # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as file:
+            limit, period = file.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:  # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as file:
+                limit = int(file.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as file:
+                period = int(file.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+# sized from the CPUs, sync workers with more than one thread run as gthread
+CPUS = available_cpus()
+workers = int(os.getenv("GUNICORN_WORKERS", str(CPUS * 2 + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", "2"))
+
+# import the app once in the master, so the schema is created once and the
+# workers share its memory, see pre_fork for the connections
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ["true", "1"]
+
+# GUNICORN_WORKER_CLASS=gevent keeps up to worker_connections requests in
+# flight in each worker while they wait on PostgreSQL, instead of one
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+if worker_class == "gevent":
+    # patch before the app is imported so its locks and sockets cooperate,
+    # and make psycopg2 yield to other requests while it waits on the server
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# every request in flight holds a connection, so size the pool of each worker
+# to match unless DB_POOL_SIZE is set, but keep the workers within
+# DB_MAX_CONNECTIONS in total, leaving one per worker for the change feed
+concurrency = worker_connections if worker_class == "gevent" else threads
+max_connections = int(os.getenv("DB_MAX_CONNECTIONS", "90"))
+per_worker = max(1, max_connections // workers - 1)
+os.environ.setdefault("DB_POOL_SIZE", str(min(concurrency, per_worker)))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(max(
+    0, per_worker - int(os.environ["DB_POOL_SIZE"]))))
+
+# the workers must share their metrics for /metrics to report all of them
+if workers > 1:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(
+        tempfile.gettempdir(), "promotion-metrics-{}".format(PORT)))
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    # a preloaded app records its startup metrics before on_starting runs
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def on_starting(server):
+    """ Clears Prometheus files left by the workers of a previous run """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        master = "_{}.db".format(os.getpid())
+        for name in os.listdir(directory):
+            if name.endswith(".db") and not name.endswith(master):
+                os.remove(os.path.join(directory, name))
+
+
+def pre_fork(server, worker):
+    """
+    Closes the connections the master opened while loading the app, so each
+    worker starts on an empty pool of its own instead of sharing sockets
+    """
+    from service import app
+    if preload_app and "sqlalchemy" in app.extensions:
+        from service.models import db
+        db.session.remove()  # dispose() only closes the connections checked in
+        db.engine.dispose()
+
+
+def post_worker_init(worker):
+    """ Starts the scheduler thread of a worker once its app is loaded """
+    from service import create_app
+    app = create_app()
+    from service.models import db
+    db.session.remove()  # start without a session the master left behind
+    if app.config.get("SCHEDULER_ENABLED"):
+        from service.scheduler import scheduler
+        scheduler.start()
+
+
+def child_exit(server, worker):
+    """ Drops the live metrics of a worker that exited """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,4 @@
+"""
+Package: benchmarks
+HTTP load benchmarks for the Promotion service, run with python -m benchmarks.run
+"""
@@ -19,5 +19,74 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Create missing tables on start, turn off when every worker imports the app
+DB_CREATE_SCHEMA = os.getenv("DB_CREATE_SCHEMA", "true").lower() in ["true", "1"]
+
+# Database connection pool, applied by Promotion.init_db
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, -1 never
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ["true", "1"]
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))  # ms, 0 none
+
+# Pagination and streaming of promotion lists
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# Encoder of promotion payloads: auto (orjson when installed), orjson or json
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto").lower()
+
+# Responses smaller than COMPRESS_MIN_SIZE bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))  # gzip, 1-9
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))  # 0-11
+
+# Rows written per transaction by POST /promotions/bulk
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+
+# Read-through cache in front of Promotion.find (size 0 disables it)
+PROMOTION_CACHE_SIZE = int(os.getenv("PROMOTION_CACHE_SIZE", "1024"))
+PROMOTION_CACHE_TTL = float(os.getenv("PROMOTION_CACHE_TTL", "60"))
+
+# Seconds before the in-memory index behind /promotions/live is reloaded,
+# which bounds how long writes made by other workers stay invisible, and the
+# most Promotions it holds, as every worker keeps its own copy
+LIVE_INDEX_TTL = float(os.getenv("LIVE_INDEX_TTL", "60"))
+LIVE_INDEX_MAX_ROWS = int(os.getenv("LIVE_INDEX_MAX_ROWS", "100000"))
+
+# Title searches: the minimum trigram similarity of a fuzzy match, the
+# seconds before the in-memory title index (used without pg_trgm) is reloaded,
+# and the most titles it holds, as every worker keeps its own copy
+TITLE_SIMILARITY = float(os.getenv("TITLE_SIMILARITY", "0.3"))
+TITLE_INDEX_TTL = float(os.getenv("TITLE_INDEX_TTL", "60"))
+TITLE_INDEX_MAX_ROWS = int(os.getenv("TITLE_INDEX_MAX_ROWS", "50000"))
+
+# Activates and deactivates promotions as their start and end dates pass, in
+# a thread of every gunicorn worker (see service/scheduler.py). The thread
+# wakes up for the dates due within SCHEDULER_HORIZON seconds, and at least
+# every SCHEDULER_INTERVAL seconds for the writes of the other workers
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() in ["true", "1"]
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", "60"))
+SCHEDULER_HORIZON = float(os.getenv("SCHEDULER_HORIZON", "3600"))
+
+# Change feed on /promotions/changes (see service/changes.py): the seconds a
+# Server-Sent Events response stays open before the client reconnects and
+# between keep-alive comments, the latest changes each worker keeps in memory,
+# the longest wait for a NOTIFY before the change log is polled, and the
+# seconds changes stay in the log before the scheduler prunes them
+CHANGES_STREAM_TIMEOUT = float(os.getenv("CHANGES_STREAM_TIMEOUT", "300"))
+CHANGES_HEARTBEAT = float(os.getenv("CHANGES_HEARTBEAT", "15"))
+CHANGES_BUFFER_SIZE = int(os.getenv("CHANGES_BUFFER_SIZE", "10000"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "5"))
+CHANGES_RETENTION = float(os.getenv("CHANGES_RETENTION", "604800"))  # 7 days
+
+# On-demand profiling of requests that send the PROFILE_HEADER header,
+# dumps go to PROFILE_DIR or are summarized in the response headers
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ["true", "1"]
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -22,12 +22,9 @@ ID_PREFIX = 'promotion_'
 def step_impl(context):
     """ Delete all Promotions and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the promotions and delete them one by one
-    context.resp = requests.get(context.base_url + '/promotions', headers=headers)
+    # delete all of the promotions with one request
+    context.resp = requests.delete(context.base_url + '/promotions?all=true', headers=headers)
     expect(context.resp.status_code).to_equal(200)
-    for promotion in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/promotions/' + str(promotion["id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
     
     # load the database with new promotions
     create_url = context.base_url + '/promotions'
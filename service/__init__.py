@@ -1,44 +1,110 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module creates the Flask app. create_app() sets up the logging and the
+SQL database, either eagerly (gunicorn "service:create_app()" and the flask
+commands) or lazily on the first request, so importing the package does not
+touch the database. The optional modules (metrics, profiling, compression
+hook, change feed and the flask commands) are imported at the same time,
+by load_extensions(), so importing the package only loads the API routes
 """
-import os
+import time
+
+STARTED = time.perf_counter()
+
 import sys
 import logging
-from flask import Flask
+from flask import Flask, _request_ctx_stack, has_request_context
+from flask.cli import AppGroup
+
+
+class ServiceCommands(AppGroup):
+    """ The flask commands, added by the optional modules when one is looked up """
+
+    def get_command(self, ctx, cmd_name):
+        load_extensions()
+        return super().get_command(ctx, cmd_name)
+
+    def list_commands(self, ctx):
+        load_extensions()
+        return super().list_commands(ctx)
+
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object("config")
+app.cli = ServiceCommands(app.name)
 
 # Import the rutes After the Flask app is created
-from service import routes, models, error_handlers
-
-# Set up logging for production
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info("  P R O M O T I O N   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    routes.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service inititalized!")
+from service import routes, models, error_handlers, compression
+
+EXTENSIONS_LOADED = False
+
+
+def load_extensions():
+    """
+    Imports the optional modules, which register their routes, hooks and
+    commands, and returns True the first time
+    """
+    global EXTENSIONS_LOADED
+    if EXTENSIONS_LOADED:
+        return False
+    EXTENSIONS_LOADED = True
+    from service import importer, metrics, profiling, schema, scheduler, changes  # pylint: disable=unused-import
+    # after_request hooks run last registered first, so registering compression
+    # last has metrics and profiling count the bytes sent
+    app.after_request(compression.compress_response)
+    return True
+
+
+def create_app():
+    """
+    Application factory, initializes the service once and returns the app
+    Exits with code 4 when the database cannot be used, which tells gunicorn
+    to stop spawning workers
+    """
+    try:
+        load_extensions()
+        initialize()
+    except Exception as error:
+        app.logger.critical("%s: Cannot continue", error)
+        sys.exit(4)
+    return app
+
+
+@app.before_first_request
+def initialize():
+    """ Sets up logging and the database unless that has been done """
+    if load_extensions() and has_request_context():
+        # the first request was routed before the optional routes were added
+        _request_ctx_stack.top.request.routing_exception = None
+        _request_ctx_stack.top.match_request()
+    if "sqlalchemy" in app.extensions:
+        return
+    # Set up logging for production
+    if __name__ != "__main__":
+        gunicorn_logger = logging.getLogger("gunicorn.error")
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+        app.logger.propagate = False
+        # Make all log formats consistent
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+        for handler in app.logger.handlers:
+            handler.setFormatter(formatter)
+        app.logger.info("Logging handler established")
+
+    app.logger.info(70 * "*")
+    app.logger.info("  P R O M O T I O N   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    from service import metrics, schema
+    routes.init_db()
+    # one query while the schema is current, DDL only when it is not
+    schema.check_schema(upgrade=app.config.get("DB_CREATE_SCHEMA", True))
+    # end the transaction of the check, a preloaded master must not hold a
+    # connection the forked workers would inherit
+    models.db.session.remove()
+    metrics.record_startup("initialized", time.perf_counter() - STARTED)
+    app.logger.info("Service inititalized!")
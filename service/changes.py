@@ -0,0 +1,249 @@
+"""
+Change Feed for Promotion Service
+Sends the creates, updates, deletes, activations and deactivations of
+Promotions on /promotions/changes, as Server-Sent Events or as JSON to long
+polling clients, numbered by their sequence number in the change log
+
+A thread of every worker LISTENs for the NOTIFY sent by each commit that
+logs changes, loads the new changes once into a buffer of the latest
+CHANGES_BUFFER_SIZE and wakes up the responses waiting for them, so a write
+costs each worker one query however many clients are connected. Clients
+that fall further behind, or reconnect with the Last-Event-ID of the last
+event they saw, read the changes they missed from the change log table
+
+Every open stream holds a thread of a sync gunicorn worker, run the gevent
+worker class to serve many clients
+"""
+
+import select
+import threading
+import time
+from collections import deque
+from itertools import islice
+from flask import Response, abort, request, stream_with_context
+from service.models import db, PromotionChange
+from service.encoding import dumps, json_response
+from service.routes import get_int_arg
+from . import app, status
+
+
+class ChangeFeed:
+    """
+    Class that represents the latest changes seen by this process and the
+    thread that loads them as they are committed
+    """
+
+    def __init__(self, buffer_size=10000, poll_interval=5.0):
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self._recent = deque(maxlen=buffer_size)  # serialized changes up to _latest
+        self._latest = None  # sequence number of the last change loaded
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def configure(self, buffer_size, poll_interval):
+        """Sets the number of changes kept and the longest wait for a NOTIFY"""
+        with self._condition:
+            self.poll_interval = poll_interval
+            if buffer_size != self.buffer_size:
+                self.buffer_size = buffer_size
+                self._recent = deque(self._recent, maxlen=buffer_size)
+
+    def load(self):
+        """Loads the changes committed since the last load and wakes up the
+        responses waiting for them"""
+        latest = PromotionChange.latest()
+        with self._condition:
+            known = self._latest
+        if latest == known:
+            return
+        if known is None or latest < known:
+            known = 0  # first load, or the log was recreated
+        since = max(known, latest - self.buffer_size)
+        changes = [change.serialize() for change in PromotionChange.find_after(since)
+                   if change.seq <= latest]
+        with self._condition:
+            # the buffer only holds an unbroken run of sequence numbers
+            if since != self._latest or (changes and changes[0]["seq"] != since + 1):
+                self._recent.clear()
+            self._recent.extend(changes)
+            self._latest = latest
+            self._condition.notify_all()
+
+    def read(self, after, limit):
+        """Returns the changes after a sequence number, oldest first
+
+        Args:
+            after (int): the sequence number of the last change seen
+            limit (int): the maximum number of changes to return
+
+        Returns:
+            (changes, last) where last is the sequence number to read after
+            next, changes is None when the changes after `after` were pruned
+            or the log was recreated, so the client must reload the Promotions
+        """
+        with self._condition:
+            if self._latest is not None and self._recent and \
+                    self._recent[0]["seq"] - 1 <= after < self._latest:
+                start = after - self._recent[0]["seq"] + 1
+                changes = list(islice(self._recent, start, start + limit))
+                return changes, changes[-1]["seq"]
+            if self._latest is not None and after == self._latest:
+                return [], after
+        changes = [change.serialize() for change in PromotionChange.find_after(after, limit)]
+        if changes and changes[0]["seq"] == after + 1:
+            return changes, changes[-1]["seq"]
+        latest = PromotionChange.latest()
+        if not changes and after == latest:
+            return [], after
+        return None, latest
+
+    def wait(self, after, timeout):
+        """Waits for a change after a sequence number, returns False when
+        the timeout passed first"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._latest is not None and self._latest > after, timeout)
+
+    def run(self):
+        """Loads the changes as they are committed until stop() is called"""
+        while not self._stopping.is_set():
+            connection = None
+            with app.app_context():
+                try:
+                    connection = self._listen()
+                    while not self._stopping.is_set():
+                        try:
+                            self.load()
+                        finally:
+                            db.session.remove()
+                        # a missed NOTIFY is picked up by the next poll
+                        if select.select([connection], [], [], self.poll_interval)[0]:
+                            connection.poll()
+                            del connection.notifies[:]
+                except Exception:  # pylint: disable=broad-except
+                    app.logger.exception("Change feed failed, listening again")
+                    self._stopping.wait(self.poll_interval)
+                finally:
+                    if connection is not None:
+                        connection.close()
+
+    def _listen(self):
+        """Returns a connection of its own that LISTENs for changes"""
+        fairy = db.engine.raw_connection()
+        fairy.detach()  # the pool opens another one in its place
+        connection = fairy.connection
+        connection.rollback()  # end the transaction of the pre-ping
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("LISTEN " + PromotionChange.CHANNEL)
+        return connection
+
+    def start(self):
+        """Runs the listener in a daemon thread of this process"""
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self.run, name="promotion-changes", daemon=True)
+            self._thread.start()
+        app.logger.info("Change feed started")
+
+    def stop(self, timeout=None):
+        """Stops the listener thread and waits for it to finish"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+feed = ChangeFeed()
+
+######################################################################
+# STREAM PROMOTION CHANGES
+######################################################################
+
+
+@app.route("/promotions/changes", methods=["GET"])
+def list_promotion_changes():
+    """
+    Sends the changes to Promotions after the Last-Event-ID header or the
+    after query parameter, or from now on when neither is sent
+    As Server-Sent Events for up to CHANGES_STREAM_TIMEOUT seconds, or as
+    JSON once there is a change or wait seconds passed to clients that only
+    accept application/json
+    """
+    app.logger.info("Request for promotion changes")
+    if not PromotionChange.is_maintained():
+        abort(status.HTTP_501_NOT_IMPLEMENTED, "The change feed needs PostgreSQL")
+    after = get_int_arg("after")
+    if request.headers.get("Last-Event-ID"):
+        try:
+            after = int(request.headers["Last-Event-ID"])
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, "Last-Event-ID must be an integer")
+    if after is None:
+        after = PromotionChange.latest()
+    feed.configure(app.config["CHANGES_BUFFER_SIZE"], app.config["CHANGES_POLL_INTERVAL"])
+    feed.start()
+    best = request.accept_mimetypes.best_match(
+        ["text/event-stream", "application/json"], default="text/event-stream")
+    if best == "application/json":
+        return poll_changes(after)
+    return stream_changes(after)
+
+
+def poll_changes(after):
+    """ Returns the changes after a sequence number once there is one """
+    limit = min(get_int_arg("limit", 1) or app.config["PAGE_SIZE_DEFAULT"],
+                app.config["PAGE_SIZE_MAX"])
+    wait = get_int_arg("wait")
+    wait = app.config["CHANGES_HEARTBEAT"] if wait is None else wait
+    wait = min(wait, app.config["CHANGES_STREAM_TIMEOUT"])
+    changes, last = feed.read(after, limit)
+    if changes == [] and feed.wait(after, wait):
+        changes, last = feed.read(after, limit)
+    return json_response({
+        "last_event_id": last,
+        "reset": changes is None,
+        "changes": changes or [],
+    }, status.HTTP_200_OK)
+
+
+def stream_changes(after):
+    """ Streams the changes after a sequence number as Server-Sent Events """
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+    heartbeat = app.config["CHANGES_HEARTBEAT"]
+    deadline = time.monotonic() + app.config["CHANGES_STREAM_TIMEOUT"]
+    db.session.remove()  # do not hold a connection while the stream is open
+
+    def generate():
+        position = after
+        # reconnect quickly once the stream ends, from the last event seen
+        yield b"retry: 1000\n\n"
+        while True:
+            changes, position = feed.read(position, batch_size)
+            db.session.remove()
+            if changes is None:
+                yield b"id: %d\nevent: reset\ndata: %s\n\n" % (
+                    position, dumps({"seq": position}))
+            elif changes:
+                yield b"".join(
+                    b"id: %d\nevent: %s\ndata: %s\n\n" % (
+                        change["seq"], change["action"].encode(), dumps(change))
+                    for change in changes)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if changes:
+                continue  # there may be more to catch up with
+            if not feed.wait(position, min(remaining, heartbeat)):
+                yield b": keep-alive\n\n"
+
+    response = Response(stream_with_context(generate()),
+                        status=status.HTTP_200_OK, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # tell nginx not to buffer
+    return response
@@ -0,0 +1,173 @@
+"""
+Response Compression for Promotion Service
+Compresses responses with brotli (when installed) or gzip as negotiated
+through Accept-Encoding. Buffered responses smaller than COMPRESS_MIN_SIZE
+are sent as they are, streamed responses are compressed chunk by chunk as
+they are sent
+
+Static files are served from the .br or .gz copies next to them, which
+flask compress-static writes at build time
+
+compress_response is registered by the service package after every other
+after_request hook, so it runs first and the others see the compressed body
+"""
+
+import gzip
+import mimetypes
+import os
+import zlib
+import click
+from flask import request, send_from_directory
+from . import app
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "image/svg+xml",
+    "text/",
+)
+EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+
+def negotiate_encoding():
+    """ Returns the best encoding the client accepts, or None """
+    encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Compressor:
+    """
+    Class that represents an incremental brotli or gzip compressor
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(
+                quality=app.config.get("COMPRESS_BROTLI_QUALITY", 4))
+        else:
+            # wbits 31 writes the gzip header and trailer
+            self.compressor = zlib.compressobj(
+                app.config.get("COMPRESS_LEVEL", 6), zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """ Returns the compressed data that can be sent so far """
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Returns the end of the compressed stream """
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def compress_stream(chunks, encoding, charset="utf-8"):
+    """ Yields the compressed chunks of a streamed response as they come """
+    compressor = Compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(charset)
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(response):
+    """ Compresses the response when the client accepts it and it is worth it """
+    if not response.mimetype or \
+            not response.mimetype.startswith(COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.direct_passthrough or "Content-Encoding" in response.headers \
+            or response.status_code in (204, 304) or request.method == "HEAD" \
+            or response.status_code < 200:
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(
+            response.response, encoding, response.charset)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config.get("COMPRESS_MIN_SIZE", 1024):
+            return response
+        compressor = Compressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers["Content-Encoding"] = encoding
+    # the compressed bytes differ, so the validator is only weakly equal
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+######################################################################
+# PRECOMPRESSED STATIC FILES
+######################################################################
+
+
+def send_static_compressed(filename):
+    """ Sends a static file, from its precompressed copy when there is one """
+    encoding = negotiate_encoding()
+    if encoding is not None:
+        compressed = filename + EXTENSIONS[encoding]
+        if _is_fresh(os.path.join(app.static_folder, compressed),
+                     os.path.join(app.static_folder, filename)):
+            response = send_from_directory(
+                app.static_folder, compressed,
+                mimetype=mimetypes.guess_type(filename)[0])
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            return response
+    return app.send_static_file(filename)
+
+
+def _is_fresh(compressed, original):
+    """ Tells whether a precompressed copy exists and is not older than the file """
+    try:
+        return os.path.getmtime(compressed) >= os.path.getmtime(original)
+    except OSError:
+        return False
+
+
+app.view_functions["static"] = send_static_compressed
+
+
+@app.cli.command("compress-static")
+def compress_static_command():
+    """Write .gz (and .br) copies of the compressible static files."""
+    minimum = app.config.get("COMPRESS_MIN_SIZE", 1024)
+    for root, _, names in os.walk(app.static_folder):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith(tuple(EXTENSIONS.values())) or \
+                    os.path.getsize(path) < minimum or \
+                    not name.endswith((".html", ".css", ".js", ".json", ".svg", ".txt")):
+                continue
+            with open(path, "rb") as source:
+                data = source.read()
+            copies = {".gz": gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                copies[".br"] = brotli.compress(data, quality=11)
+            for extension, compressed in copies.items():
+                with open(path + extension, "wb") as target:
+                    target.write(compressed)
+                click.echo("{} {} -> {} bytes".format(
+                    path + extension, len(data), len(compressed)))
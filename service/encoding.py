@@ -0,0 +1,77 @@
+"""
+JSON Encoding for Promotion Service
+Promotion payloads are encoded with orjson when it is installed, otherwise
+with the standard library after every date has been turned into an ISO 8601
+string up front, so neither path calls a default() hook once per value
+
+Set JSON_BACKEND to orjson or json to force one of them. Both produce the
+same document, with dates as ISO 8601 strings such as 2021-03-01T00:00:00Z.
+The database stores naive UTC timestamps, so they are sent with the Z that
+makes clients parse them as UTC rather than local time
+"""
+
+import json
+from datetime import date, datetime
+from flask import Response
+from flask.json import JSONEncoder
+from . import app
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+# naive datetimes are UTC, written with a Z like isoformat() below
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z if orjson else 0
+
+
+def isoformat(value):
+    """ Returns a date as ISO 8601, with a Z when it is a naive UTC datetime """
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.isoformat() + "Z"
+    return value.isoformat()
+
+
+class ISOJSONEncoder(JSONEncoder):
+    """ Encodes dates as ISO 8601 in the responses still built by jsonify """
+
+    def default(self, o):  # pylint: disable=method-hidden
+        if isinstance(o, date):
+            return isoformat(o)
+        return super().default(o)
+
+
+def use_orjson():
+    """ Returns True when payloads should be encoded with orjson """
+    backend = app.config.get("JSON_BACKEND", "auto")
+    if backend == "json" or orjson is None:
+        return False
+    return True
+
+
+def iso_dates(row):
+    """ Returns a copy of a dictionary with its dates as ISO 8601 strings """
+    return {name: isoformat(value) if isinstance(value, date) else value
+            for name, value in row.items()}
+
+
+def dumps(value):
+    """ Returns a serialized Promotion, or a list of them, as JSON bytes """
+    if use_orjson():
+        return orjson.dumps(value, option=ORJSON_OPTIONS)
+    if isinstance(value, dict):
+        value = iso_dates(value)
+    elif isinstance(value, list):
+        value = [iso_dates(row) if isinstance(row, dict) else row for row in value]
+    return json.dumps(value, ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def json_response(value, status=200, headers=None):
+    """ Returns a JSON Response of a serialized Promotion or list of them """
+    return Response(dumps(value), status=status, headers=headers,
+                    mimetype="application/json")
+
+
+app.json_encoder = ISOJSONEncoder
@@ -3,7 +3,7 @@
 ######################################################################
 
 from flask import jsonify
-from service.models import DataValidationError
+from service.models import DataValidationError, SearchUnavailableError
 from . import app, status
 
 
@@ -13,6 +13,12 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(SearchUnavailableError)
+def search_unavailable_error(error):
+    """ Handles searches the database cannot answer """
+    return not_implemented(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -68,6 +74,21 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_501_NOT_IMPLEMENTED)
+def not_implemented(error):
+    """ Handles features the database cannot support with 501_NOT_IMPLEMENTED """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_501_NOT_IMPLEMENTED,
+            error="Not Implemented",
+            message=message,
+        ),
+        status.HTTP_501_NOT_IMPLEMENTED,
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
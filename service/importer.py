@@ -0,0 +1,187 @@
+"""
+Promotion Importer
+Bulk loads promotions from a CSV or NDJSON file (or stdin) as a stream
+
+Usage:
+    flask promotions import promotions.csv
+    cat promotions.ndjson | python -m service.importer --format ndjson -
+
+Every row is validated with Promotion.deserialize and its dates parsed. On
+PostgreSQL each batch is loaded with COPY, elsewhere with one executemany
+INSERT
+"""
+
+import csv
+import io
+import sys
+import time
+from datetime import datetime, timezone
+import click
+from flask.cli import AppGroup, ScriptInfo
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import db, Promotion, PromotionVersion, DataValidationError
+from service.routes import read_ndjson
+from . import app
+
+COLUMNS = ["title", "promotion_type", "start_date", "end_date", "active"]
+
+
+def read_csv(stream):
+    """ Yields one dictionary per CSV row with active parsed as a boolean """
+    for row in csv.DictReader(stream):
+        if isinstance(row.get("active"), str):
+            row["active"] = row["active"].strip().lower() in ["true", "1"]
+        yield row
+
+
+def parse_dates(promotion):
+    """ Parses the ISO 8601 dates of a Promotion into naive UTC datetimes """
+    for name in ["start_date", "end_date"]:
+        value = getattr(promotion, name)
+        if not isinstance(value, str):
+            continue
+        try:
+            moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            raise DataValidationError(
+                "Invalid promotion: {} must be an ISO 8601 date".format(name))
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        setattr(promotion, name, moment)
+    return promotion
+
+
+def import_promotions(rows, batch_size=5000, progress=None):
+    """
+    Validates and bulk loads promotions
+
+    Args:
+        rows (iterable): promotion dictionaries, or the ValueError of a bad row
+        batch_size (int): the number of rows loaded per transaction
+        progress (function): called with (imported, failed, elapsed) per batch
+
+    Returns:
+        the number of imported rows and a list of (row number, error) pairs
+    """
+    started = time.monotonic()
+    imported = 0
+    errors = []
+    batch = []
+    for number, row in enumerate(rows, 1):
+        try:
+            if isinstance(row, Exception):
+                raise row
+            batch.append((number, parse_dates(Promotion().deserialize(row))))
+        except (DataValidationError, ValueError) as error:
+            errors.append((number, str(error)))
+        if len(batch) >= batch_size:
+            imported += load_batch(batch, errors)
+            batch = []
+            if progress:
+                progress(imported, len(errors), time.monotonic() - started)
+    if batch:
+        imported += load_batch(batch, errors)
+        if progress:
+            progress(imported, len(errors), time.monotonic() - started)
+    Promotion.changed()
+    return imported, errors
+
+
+def load_batch(batch, errors):
+    """ Loads one batch of (row number, Promotion) pairs and returns the count """
+    if db.engine.dialect.name == "postgresql":
+        try:
+            copy_batch([promotion for _, promotion in batch])
+            PromotionVersion.bump()
+            db.session.commit()
+            return len(batch)
+        except Exception as error:  # pylint: disable=broad-except
+            db.session.rollback()
+            app.logger.warning("COPY failed, loading the batch row by row: %s",
+                               str(error).splitlines()[0])
+    return insert_batch(batch, errors)
+
+
+def insert_batch(batch, errors):
+    """ Loads one batch with an executemany INSERT, or row by row when that
+    fails so only the bad rows are rejected, and returns the count """
+    insert = Promotion.__table__.insert()
+    rows = []
+    for _, promotion in batch:
+        row = {name: getattr(promotion, name) for name in COLUMNS}
+        if row["active"] is None:
+            row["active"] = False
+        rows.append(row)
+    try:
+        db.session.execute(insert, rows)
+        loaded = len(rows)
+    except SQLAlchemyError:
+        db.session.rollback()
+        loaded = 0
+        for (number, _), row in zip(batch, rows):
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert, [row])
+                loaded += 1
+            except SQLAlchemyError as error:
+                errors.append((number, "Invalid promotion: " + str(
+                    getattr(error, "orig", error)).splitlines()[0]))
+    PromotionVersion.bump()
+    db.session.commit()
+    return loaded
+
+
+def copy_batch(promotions):
+    """ Streams Promotions into the table with PostgreSQL COPY """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for promotion in promotions:
+        writer.writerow([getattr(promotion, name) for name in COLUMNS])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        "COPY promotion ({}) FROM STDIN WITH (FORMAT csv)".format(", ".join(COLUMNS)),
+        buffer,
+    )
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+
+promotions_cli = AppGroup("promotions", help="Manage promotions in bulk.")
+
+
+@promotions_cli.command("import")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="Input format, guessed from the file name when omitted.")
+@click.option("--batch-size", default=5000, show_default=True,
+              help="Rows loaded per transaction.")
+def import_command(source, file_format, batch_size):
+    """Import promotions from a CSV or NDJSON file, or - for stdin."""
+    from service import create_app
+    create_app()
+    if file_format is None:
+        file_format = "csv" if source.name.endswith(".csv") else "ndjson"
+    rows = read_csv(source) if file_format == "csv" else read_ndjson(source)
+
+    def progress(imported, failed, elapsed):
+        rate = imported / elapsed if elapsed else 0.0
+        click.echo("{} imported, {} failed, {:.0f} rows/sec".format(
+            imported, failed, rate), err=True)
+
+    imported, errors = import_promotions(rows, batch_size, progress)
+    for number, message in errors[:20]:
+        click.echo("row {}: {}".format(number, message), err=True)
+    if len(errors) > 20:
+        click.echo("... and {} more errors".format(len(errors) - 20), err=True)
+    click.echo("Imported {} promotions".format(imported))
+    if errors:
+        sys.exit(1)
+
+
+app.cli.add_command(promotions_cli)
+
+if __name__ == "__main__":
+    import_command(obj=ScriptInfo(create_app=lambda info: app))  # pylint: disable=no-value-for-parameter
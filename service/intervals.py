@@ -0,0 +1,142 @@
+"""
+Interval Index for Promotion Service
+A centered interval tree over half-open [start, end) intervals that answers
+"which intervals contain time T" in O(log n + k)
+"""
+
+from bisect import bisect_left, insort
+
+
+class _Node:
+    """A tree node holding every interval that contains its center"""
+
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, center):
+        self.center = center
+        self.by_start = []  # (start, key) sorted ascending
+        self.by_end = []  # (end, key) sorted ascending
+        self.left = None  # intervals that end before center
+        self.right = None  # intervals that start after center
+
+
+def _midpoint(start, end):
+    return start + (end - start) / 2
+
+
+class IntervalTree:
+    """
+    Class that represents a set of keyed intervals
+    Intervals are added and removed one at a time, and the tree is rebuilt
+    balanced once the number of changes since the last build exceeds its size
+    """
+
+    def __init__(self, intervals=None):
+        self._root = None
+        self._intervals = {}  # key -> (start, end, node)
+        self._changes = 0
+        if intervals:
+            self.rebuild(intervals)
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __contains__(self, key):
+        return key in self._intervals
+
+    def add(self, key, start, end):
+        """Adds or replaces the interval [start, end) stored under key"""
+        self.remove(key)
+        if not start < end:
+            return
+        node = self._node_for(start, end)
+        insort(node.by_start, (start, key))
+        insort(node.by_end, (end, key))
+        self._intervals[key] = (start, end, node)
+        self._changes += 1
+        if self._changes > max(64, len(self._intervals)):
+            self.rebuild()
+
+    def remove(self, key):
+        """Removes the interval stored under key if there is one"""
+        entry = self._intervals.pop(key, None)
+        if entry is None:
+            return
+        start, end, node = entry
+        del node.by_start[bisect_left(node.by_start, (start, key))]
+        del node.by_end[bisect_left(node.by_end, (end, key))]
+        self._changes += 1
+
+    def rebuild(self, intervals=None):
+        """Rebuilds a balanced tree from (key, start, end) tuples
+
+        Args:
+            intervals (list): the intervals to index, or None to rebalance
+                the intervals already stored
+        """
+        if intervals is None:
+            intervals = [(key, start, end) for key, (start, end, _)
+                         in self._intervals.items()]
+        self._intervals = {}
+        self._root = self._build(
+            [(key, start, end) for key, start, end in intervals if start < end])
+        self._changes = 0
+
+    def at(self, point):
+        """Yields the keys of every interval with start <= point < end"""
+        node = self._root
+        while node is not None:
+            if point < node.center:
+                for start, key in node.by_start:
+                    if start > point:
+                        break
+                    yield key
+                node = node.left
+            else:
+                for end, key in reversed(node.by_end):
+                    if end <= point:
+                        break
+                    yield key
+                node = node.right
+
+    def _node_for(self, start, end):
+        """Returns the node an interval belongs to, creating it if needed"""
+        if self._root is None:
+            self._root = _Node(_midpoint(start, end))
+            return self._root
+        node = self._root
+        while True:
+            if end < node.center:
+                if node.left is None:
+                    node.left = _Node(_midpoint(start, end))
+                    return node.left
+                node = node.left
+            elif start > node.center:
+                if node.right is None:
+                    node.right = _Node(_midpoint(start, end))
+                    return node.right
+                node = node.right
+            else:
+                return node
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        points = sorted(point for _, start, end in intervals
+                        for point in (start, end))
+        node = _Node(points[len(points) // 2])
+        left, right = [], []
+        for key, start, end in intervals:
+            if end < node.center:
+                left.append((key, start, end))
+            elif start > node.center:
+                right.append((key, start, end))
+            else:
+                node.by_start.append((start, key))
+                node.by_end.append((end, key))
+                self._intervals[key] = (start, end, node)
+        node.by_start.sort()
+        node.by_end.sort()
+        node.left = self._build(left)
+        node.right = self._build(right)
+        return node
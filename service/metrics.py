@@ -0,0 +1,130 @@
+"""
+Metrics for Promotion Service
+Records per-endpoint request counts, latency, response sizes and the number
+of SQL statements each request runs, and exports them in the Prometheus
+text format on /metrics
+
+When several gunicorn workers run, set PROMETHEUS_MULTIPROC_DIR to a
+directory shared by the workers so /metrics aggregates all of them
+"""
+
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app, STARTED
+
+REQUESTS = Counter(
+    "promotion_http_requests_total",
+    "HTTP requests by endpoint, method and status code",
+    ["endpoint", "method", "status"],
+)
+LATENCY = Histogram(
+    "promotion_http_request_duration_seconds",
+    "HTTP request latency by endpoint and method",
+    ["endpoint", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+RESPONSE_SIZE = Histogram(
+    "promotion_http_response_size_bytes",
+    "HTTP response body size by endpoint and method",
+    ["endpoint", "method"],
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000, 100000000),
+)
+SQL_STATEMENTS = Histogram(
+    "promotion_http_request_sql_statements",
+    "SQL statements executed per HTTP request by endpoint and method",
+    ["endpoint", "method"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+STARTUP = Gauge(
+    "promotion_startup_seconds",
+    "Seconds from importing the service until it was initialized and "
+    "until it sent its first response",
+    ["phase"],
+    multiprocess_mode="max",
+)
+
+STARTUP_PHASES = set()
+
+
+def record_startup(phase, seconds):
+    """ Records how long a phase of the start took, once per process """
+    if phase in STARTUP_PHASES:
+        return
+    STARTUP_PHASES.add(phase)
+    STARTUP.labels(phase).set(seconds)
+    app.logger.info("Startup phase %s took %.0f ms", phase, seconds * 1000)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Counts the SQL statements run on behalf of the current request """
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+
+
+@app.before_request
+def start_request_metrics():
+    """ Starts timing the request """
+    g.request_started = time.perf_counter()
+    g.sql_statements = 0
+
+
+@app.after_request
+def record_request_metrics(response):
+    """ Records the latency, size and SQL statements of the request, the
+    latency and SQL statements of a streamed response once it was sent """
+    if "request_started" not in g:
+        return response
+    if "first_response" not in STARTUP_PHASES:
+        record_startup("first_response", time.perf_counter() - STARTED)
+    endpoint = request.endpoint or "unmatched"
+    method = request.method
+    REQUESTS.labels(endpoint, method, response.status_code).inc()
+    if response.is_streamed:
+        # the body is generated as it is sent, after this hook, and the
+        # request context may be gone by the time the server closes it.
+        # Streams have no length up front, asking for one would buffer them
+        request_globals = g._get_current_object()  # pylint: disable=protected-access
+        response.call_on_close(
+            lambda: record_request_time(endpoint, method, request_globals))
+    else:
+        size = response.calculate_content_length()
+        if size is not None:  # None when the body is passed through as is
+            RESPONSE_SIZE.labels(endpoint, method).observe(size)
+        record_request_time(endpoint, method, g)
+    return response
+
+
+def record_request_time(endpoint, method, request_globals):
+    """ Records the latency and SQL statements of a request that was sent """
+    LATENCY.labels(endpoint, method).observe(
+        time.perf_counter() - request_globals.request_started)
+    SQL_STATEMENTS.labels(endpoint, method).observe(request_globals.sql_statements)
+
+
+######################################################################
+# EXPORT METRICS
+######################################################################
+
+
+@app.route("/metrics", methods=["GET"])
+def export_metrics():
+    """ Returns every metric in the Prometheus text exposition format """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
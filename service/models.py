@@ -9,9 +9,25 @@ Attributes
 -----------
 """
 
+import bisect
+import hashlib
 import logging
+import operator
+import threading
+import time
+from collections import Counter
 from enum import Enum
+from flask import has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, and_, event, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import load_only, make_transient_to_detached
+from sqlalchemy.orm.exc import StaleDataError
+from service.cache import LRUCache
+from service.encoding import isoformat
+from service.intervals import IntervalTree
+from service.ngrams import MODES as SEARCH_MODES, TrigramIndex
+from service.pool import engine_options
 
 logger = logging.getLogger("flask.app")
 
@@ -30,6 +46,112 @@ class DataValidationError(Exception):
     pass
 
 
+class SearchUnavailableError(Exception):
+    """Used when the database cannot answer a kind of search"""
+
+    pass
+
+
+class PromotionVersion(db.Model):
+    """
+    Class that represents the table-level change counter of Promotions
+    Every write to the promotion table increments it in the same transaction,
+    so it changes whenever any list of Promotions may have changed
+    On PostgreSQL the same row numbers the rows of the change log, see
+    PromotionChange
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    changes = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+
+    @classmethod
+    def bump(cls):
+        """Increments the counter as part of the current transaction"""
+        db.session.execute(
+            cls.__table__.update().where(cls.id == 1).values(version=cls.version + 1))
+
+    @classmethod
+    def current(cls):
+        """Returns the current value of the counter"""
+        return db.session.query(cls.version).filter(cls.id == 1).scalar() or 0
+
+
+# the counter is a single row that must exist before the first write
+event.listen(
+    PromotionVersion.__table__,
+    "after_create",
+    DDL("INSERT INTO promotion_version (id, version) VALUES (1, 0)"),
+)
+
+
+class SchemaVersion(db.Model):
+    """
+    Class that represents the version of the database schema
+    A single row written by service.schema.upgrade_schema, so a starting
+    worker checks the schema with one query instead of introspecting it
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def current(cls):
+        """Returns the stamped version, or None when there is no schema yet"""
+        try:
+            return db.session.query(cls.version).filter(cls.id == 1).scalar()
+        except SQLAlchemyError:
+            db.session.rollback()  # the table does not exist
+            return None
+
+    @classmethod
+    def stamp(cls, version):
+        """Records the version as part of the current transaction"""
+        row = cls.query.get(1)
+        if row is None:
+            db.session.add(cls(id=1, version=version))
+        else:
+            row.version = version
+
+
+class ScheduleState(db.Model):
+    """
+    Class that represents how far the start and end dates of Promotions
+    have been applied by the scheduler
+    A single row, so whichever process takes the lock next carries on from
+    where the last one stopped
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    applied_until = db.Column(db.DateTime(), nullable=True)
+
+    # PostgreSQL advisory lock held while the schedule is applied
+    LOCK_KEY = 0x70726F6D
+
+    @classmethod
+    def try_lock(cls):
+        """Takes the lock until the end of the transaction, returns False
+        when another process holds it"""
+        if db.engine.dialect.name != "postgresql":
+            return True  # SQLite runs one write transaction at a time
+        return db.session.execute(
+            "SELECT pg_try_advisory_xact_lock(:key)", {"key": cls.LOCK_KEY}).scalar()
+
+    @classmethod
+    def current(cls):
+        """Returns the moment the schedule was applied until, or None"""
+        return db.session.query(cls.applied_until).filter(cls.id == 1).scalar()
+
+    @classmethod
+    def advance(cls, moment):
+        """Records the moment as part of the current transaction"""
+        row = cls.query.get(1)
+        if row is None:
+            db.session.add(cls(id=1, applied_until=moment))
+        else:
+            row.applied_until = moment
+
+
 class Promotion(db.Model):
     """
     Class that represents a Promotion
@@ -39,17 +161,67 @@ class Promotion(db.Model):
 
     app = None
 
+    # Read-through cache of column values for find(), keyed by id
+    cache = LRUCache()
+
+    # Interval trees of [start_date, end_date) keyed by the active flag,
+    # loaded on first use and refreshed for the ids written since
+    live_index = None
+    live_index_loaded = 0.0
+    live_index_pending = set()
+    live_index_lock = threading.Lock()
+    # monotonic time until which the table is known to be too large to index
+    live_index_skipped_until = 0.0
+
+    # Trigram index of the titles for title searches on databases without
+    # pg_trgm, loaded on first use and refreshed for the ids written since
+    title_index = None
+    title_index_loaded = 0.0
+    title_index_pending = set()
+    title_index_lock = threading.Lock()
+    # monotonic time until which the table is known to be too large to index
+    title_index_skipped_until = 0.0
+
+    # Whether PostgreSQL has pg_trgm to search titles, checked on first use
+    trigram_search = None
+
+    # Callables told the ids written (None for all) after every write
+    change_listeners = []
+
+    # Columns that can be filtered and sorted on by find_by_filters()
+    FILTERS = ("title", "promotion_type", "start_date", "end_date", "active")
+
+    # Date range filters of find_by_filters(), mapped to the column and the
+    # comparison, so ranges are half open: after <= date < before
+    RANGES = {
+        "start_after": ("start_date", operator.ge),
+        "start_before": ("start_date", operator.lt),
+        "end_after": ("end_date", operator.ge),
+        "end_before": ("end_date", operator.lt),
+    }
+
+    # Columns that can be requested as a sparse fieldset, in output order
+    FIELDS = ("id",) + FILTERS
+
+    # How the title filter can match, exact is a plain equality filter
+    TITLE_MODES = ("exact",) + SEARCH_MODES
+
     ##################################################
     # Table Schema
     ##################################################
 
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(63), nullable=False)
-    promotion_type = db.Column(db.String(63), nullable=False)
-    start_date = db.Column(db.DateTime(), nullable=False)
-    end_date = db.Column(db.DateTime(), nullable=False)
+    title = db.Column(db.String(63), nullable=False, index=True)
+    promotion_type = db.Column(db.String(63), nullable=False)  # indexed by ix_promotion_type_active
+    start_date = db.Column(db.DateTime(), nullable=False, index=True)
+    end_date = db.Column(db.DateTime(), nullable=False, index=True)
     active = db.Column(db.Boolean(), nullable=False, default=False)
 
+    __table_args__ = (
+        db.Index("ix_promotion_type_active", "promotion_type", "active"),
+        db.Index("ix_promotion_active_end_date", "active", "end_date"),
+    )
+
     def __repr__(self):
         return "<Promotion %r id=[%s]>" % (self.title, self.id)
 
@@ -60,23 +232,304 @@ class Promotion(db.Model):
         logger.info("Creating %s", self.title)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
+        db.session.flush()
+        promotion_id = self.id
+        PromotionVersion.bump()
         db.session.commit()
+        Promotion.changed([promotion_id])
 
     def delete(self):
         """Removes a Pet from the data store"""
         logger.info("Deleting %s", self.title)
+        promotion_id = self.id
         db.session.delete(self)
+        db.session.flush()  # lock the row before the counter, like every write
+        PromotionVersion.bump()
         db.session.commit()
+        Promotion.changed([promotion_id])
 
     def update(self):
         """
         Updates a Promotion to the database
+
+        Returns:
+            False when the Promotion was deleted since it was read
         """
         logger.info("Updating %s", self.title)
+        promotion_id = self.id
+        try:
+            db.session.flush()  # lock the row before the counter, like every write
+        except StaleDataError:
+            db.session.rollback()
+            Promotion.changed([promotion_id])
+            return False
+        PromotionVersion.bump()
         db.session.commit()
+        Promotion.changed([promotion_id])
+        return True
 
-    def serialize(self):
-        """Serializes a Promotion into a dictionary"""
+    @classmethod
+    def create_many(cls, promotions, batch_size=1000):
+        """Creates Promotions in batches, committing once per batch
+
+        On PostgreSQL ids are reserved from the sequence and each batch is
+        written by one multi-row INSERT. A batch that fails is retried row
+        by row so only the bad rows are rejected.
+
+        Args:
+            promotions (list): deserialized Promotions to create
+            batch_size (int): the number of rows written per transaction
+
+        Returns:
+            a list with the new id of each Promotion, and a dict of error
+            messages for the positions that could not be created
+        """
+        logger.info("Creating %s Promotions in batches of %s",
+                    len(promotions), batch_size)
+        ids = [None] * len(promotions)
+        errors = {}
+        for offset in range(0, len(promotions), batch_size):
+            batch = promotions[offset:offset + batch_size]
+            try:
+                batch_ids = cls._insert_batch(batch)
+                PromotionVersion.bump()
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                batch_ids = []
+                for position, promotion in enumerate(batch, offset):
+                    promotion_id = None
+                    try:
+                        with db.session.begin_nested():
+                            promotion_id = cls._insert_batch([promotion])[0]
+                    except SQLAlchemyError as error:
+                        errors[position] = "Invalid promotion: " + str(
+                            getattr(error, "orig", error)).splitlines()[0]
+                    batch_ids.append(promotion_id)
+                PromotionVersion.bump()
+                db.session.commit()
+            ids[offset:offset + len(batch)] = batch_ids
+        cls.changed([promotion_id for promotion_id in ids if promotion_id])
+        return ids, errors
+
+    @classmethod
+    def _insert_batch(cls, promotions):
+        """Inserts Promotions without committing and returns their ids"""
+        if db.engine.dialect.name != "postgresql":
+            for promotion in promotions:
+                promotion.id = None
+            db.session.add_all(promotions)
+            db.session.flush()
+            return [promotion.id for promotion in promotions]
+        ids = [row[0] for row in db.session.execute(
+            "SELECT nextval('promotion_id_seq') FROM generate_series(1, :count)",
+            {"count": len(promotions)})]
+        rows = []
+        for promotion_id, promotion in zip(ids, promotions):
+            row = promotion.snapshot()
+            row["id"] = promotion_id
+            if row["active"] is None:
+                row["active"] = False
+            rows.append(row)
+        db.session.execute(cls.__table__.insert().values(rows))
+        return ids
+
+    @classmethod
+    def set_active(cls, active, promotion_ids=None, filters=None):
+        """Sets the active flag of many Promotions with one UPDATE statement
+
+        Args:
+            active (boolean): the new active flag
+            promotion_ids (list): only update the Promotions with these ids
+            filters (dict): only update the Promotions matching these filters
+
+        Returns:
+            the number of Promotions whose active flag changed
+        """
+        logger.info("Setting active to %s for ids %s filters %s",
+                    active, promotion_ids, filters)
+        if promotion_ids is not None and not promotion_ids:
+            return 0
+        query = cls.find_by_filters(filters or {})
+        if promotion_ids is not None:
+            query = query.filter(cls.id.in_(promotion_ids))
+        count = query.filter(cls.active != active).update(
+            {cls.active: active}, synchronize_session=False)
+        if count:
+            PromotionVersion.bump()
+        db.session.commit()
+        cls.changed(promotion_ids)
+        return count
+
+    @classmethod
+    def patch(cls, promotion_id, data):
+        """Changes some columns of a Promotion with one UPDATE statement
+
+        On PostgreSQL the new row comes back from UPDATE ... RETURNING,
+        elsewhere the Promotion is loaded and updated through the ORM
+
+        Args:
+            promotion_id (int): the id of the Promotion to change
+            data (dict): the columns to change mapped to their new values
+
+        Returns:
+            the changed Promotion, or None when there is no such Promotion
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError(
+                "Invalid promotion: body of request contained bad or no data")
+        values = {name: value for name, value in data.items() if name != "id"}
+        for name in values:
+            if name not in cls.FILTERS:
+                raise DataValidationError("Invalid field: " + name)
+        logger.info("Patching %s of promotion %s", sorted(values), promotion_id)
+        if not values:
+            return cls.find(promotion_id)
+        returning = db.engine.dialect.name == "postgresql"
+        try:
+            if returning:
+                table = cls.__table__
+                row = db.session.execute(
+                    table.update()
+                    .where(table.c.id == promotion_id)
+                    .values(**values)
+                    .returning(*table.c)
+                ).first()
+                promotion = dict(row) if row else None
+            else:
+                promotion = cls.query.get(promotion_id)
+                if promotion is not None:
+                    for name, value in values.items():
+                        setattr(promotion, name, value)
+                    db.session.flush()
+            if promotion is None:
+                db.session.rollback()
+                return None
+            PromotionVersion.bump()
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            raise DataValidationError("Invalid promotion: " + str(
+                getattr(error, "orig", error)).splitlines()[0])
+        cls.changed([promotion_id])
+        if returning:
+            # the returned row is current, so it also refills the cache
+            cls.cache.set(promotion_id, promotion)
+            promotion = cls.from_values(promotion)
+        return promotion
+
+    @classmethod
+    def apply_schedule(cls, now):
+        """Activates the Promotions that started and deactivates the ones
+        that ended since the schedule was last applied, with one UPDATE each
+
+        Args:
+            now (datetime): apply the start and end dates up to this moment
+
+        Returns:
+            (activated ids, deactivated ids), or None when another process
+            is applying the schedule
+        """
+        if not ScheduleState.try_lock():
+            db.session.rollback()
+            return None
+        since = ScheduleState.current()
+        activated, deactivated = [], []
+        # the first run only records where to start from
+        if since is not None and since < now:
+            activated = cls._flip_active(
+                True, cls.start_date > since, cls.start_date <= now, cls.end_date > now)
+            deactivated = cls._flip_active(
+                False, cls.end_date > since, cls.end_date <= now)
+        if since is None or since < now:
+            ScheduleState.advance(now)
+        if activated or deactivated:
+            PromotionVersion.bump()
+        db.session.commit()
+        if activated or deactivated:
+            logger.info("Schedule activated %s and deactivated %s promotions",
+                        len(activated), len(deactivated))
+            cls.changed(activated + deactivated)
+        return activated, deactivated
+
+    @classmethod
+    def _flip_active(cls, active, *conditions):
+        """Sets the active flag of the Promotions matching the conditions
+        in the current transaction and returns their ids"""
+        table = cls.__table__
+        where = and_(table.c.active != active, *conditions)
+        if db.engine.dialect.name == "postgresql":
+            return [row.id for row in db.session.execute(
+                table.update().where(where).values(active=active)
+                .returning(table.c.id))]
+        promotion_ids = [row.id for row in db.session.query(cls.id).filter(where)]
+        if promotion_ids:
+            db.session.execute(
+                table.update().where(table.c.id.in_(promotion_ids))
+                .values(active=active))
+        return promotion_ids
+
+    @classmethod
+    def find_boundaries(cls, since, until, promotion_ids=None):
+        """Returns the distinct start and end dates in (since, until], sorted
+
+        Args:
+            since (datetime): only dates after this moment
+            until (datetime): only dates up to this moment
+            promotion_ids (list): only the dates of these Promotions
+        """
+        dates = set()
+        for column in (cls.start_date, cls.end_date):
+            query = db.session.query(column).filter(column > since, column <= until)
+            if promotion_ids is not None:
+                query = query.filter(cls.id.in_(promotion_ids))
+            dates.update(row[0] for row in query.distinct())
+        return sorted(dates)
+
+    @classmethod
+    def delete_many(cls, promotion_ids=None, filters=None):
+        """Deletes many Promotions with one DELETE statement
+
+        Args:
+            promotion_ids (list): only delete the Promotions with these ids
+            filters (dict): only delete the Promotions matching these filters
+
+        Returns:
+            the number of Promotions deleted
+        """
+        logger.info("Deleting ids %s filters %s", promotion_ids, filters)
+        if promotion_ids is not None and not promotion_ids:
+            return 0
+        query = cls.find_by_filters(filters or {})
+        if promotion_ids is not None:
+            query = query.filter(cls.id.in_(promotion_ids))
+        count = query.delete(synchronize_session=False)
+        if count:
+            PromotionVersion.bump()
+        db.session.commit()
+        cls.changed(promotion_ids)
+        return count
+
+    def snapshot(self):
+        """Returns the column values of a Promotion as a dictionary"""
+        return {
+            column.name: getattr(self, column.name)
+            for column in self.__table__.columns
+        }
+
+    def etag(self):
+        """Returns a strong entity tag derived from the column values"""
+        values = repr(sorted(self.snapshot().items()))
+        return hashlib.sha1(values.encode("utf-8")).hexdigest()
+
+    def serialize(self, fields=None):
+        """Serializes a Promotion into a dictionary
+
+        Args:
+            fields (list): only serialize these columns, all when omitted
+        """
+        if fields:
+            return {name: getattr(self, name) for name in fields}
         return {
             "id": self.id,
             "title": self.title,
@@ -121,10 +574,45 @@ class Promotion(db.Model):
         """
         logger.info("Initializing database")
         cls.app = app
+        cls.cache.configure(app.config.get("PROMOTION_CACHE_SIZE", 1024),
+                            app.config.get("PROMOTION_CACHE_TTL", 60))
         # This is where we initialize SQLAlchemy from the Flask app
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
         db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        if not has_app_context():  # flask commands run in their own context
+            app.app_context().push()
+
+    @classmethod
+    def changed(cls, promotion_ids=None):
+        """Drops changed Promotions from the caches after a write
+
+        Args:
+            promotion_ids (list): the ids that were written, or None for all
+        """
+        if promotion_ids is None:
+            cls.cache.clear()
+        else:
+            for promotion_id in promotion_ids:
+                cls.cache.invalidate(promotion_id)
+        # past a few thousand writes a reload is cheaper than patching
+        with cls.live_index_lock:
+            if cls.live_index is not None:
+                if promotion_ids is None or \
+                        len(cls.live_index_pending) + len(promotion_ids) > 10000:
+                    cls.live_index = None
+                    cls.live_index_pending.clear()
+                else:
+                    cls.live_index_pending.update(promotion_ids)
+        with cls.title_index_lock:
+            if cls.title_index is not None:
+                if promotion_ids is None or \
+                        len(cls.title_index_pending) + len(promotion_ids) > 10000:
+                    cls.title_index = None
+                    cls.title_index_pending.clear()
+                else:
+                    cls.title_index_pending.update(promotion_ids)
+        for listener in cls.change_listeners:
+            listener(promotion_ids)
 
     @classmethod
     def all(cls):
@@ -133,10 +621,308 @@ class Promotion(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, promotion_id):
-        """ Finds a Promotion by it's ID """
+    def find_by_filters(cls, filters, sort=None, limit=None, fields=None):
+        """Returns all Promotions that match every one of the given filters
+
+        Args:
+            filters (dict): column names mapped to the values they must equal,
+                and RANGES names mapped to datetimes
+            sort (string): column name to sort by, prefix with - for descending
+            limit (int): the maximum number of Promotions to return
+            fields (list): only load these columns (and id) from the database
+        """
+        logger.info("Processing filter query for %s sort %s limit %s ...",
+                    filters, sort, limit)
+        query = cls.with_fields(cls.query, fields)
+        for name, value in filters.items():
+            if name in cls.RANGES:
+                column, compare = cls.RANGES[name]
+                query = query.filter(compare(getattr(cls, column), value))
+            elif name in cls.FILTERS:
+                query = query.filter(getattr(cls, name) == value)
+            else:
+                raise DataValidationError("Invalid filter: " + name)
+        if sort:
+            name = sort.lstrip("-")
+            if name not in cls.FILTERS + ("id",):
+                raise DataValidationError("Invalid sort: " + name)
+            column = getattr(cls, name)
+            column = column.desc() if sort.startswith("-") else column.asc()
+            query = query.order_by(column, cls.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def find_live(cls, at, active=None, fields=None, after=None, limit=None):
+        """Returns the Promotions that are running at the given time
+
+        Args:
+            at (datetime): the point in time, start_date <= at < end_date
+            active (boolean): only return Promotions with this active flag
+            fields (list): only load these columns (and id) from the database
+            after (int): cursor, only Promotions with a greater id are returned
+            limit (int): the maximum number of Promotions to return
+        """
+        logger.info("Processing live query at %s active %s after %s limit %s ...",
+                    at, active, after, limit)
+        query = cls.with_fields(cls.query, fields)
+        promotion_ids = cls.find_live_ids(at, active)
+        if promotion_ids is None:
+            # too many Promotions to index in every worker, query the dates
+            query = query.filter(cls.start_date <= at, cls.end_date > at)
+            if active is not None:
+                query = query.filter(cls.active == bool(active))
+            return cls.find_after(query, after, limit)
+        if after is not None:
+            promotion_ids = promotion_ids[bisect.bisect_right(promotion_ids, after):]
+        promotion_ids = promotion_ids[:limit]
+        promotions = []
+        for start in range(0, len(promotion_ids), 1000):
+            batch = promotion_ids[start:start + 1000]
+            promotions.extend(query.filter(cls.id.in_(batch)).order_by(cls.id))
+        return promotions
+
+    @classmethod
+    def find_live_ids(cls, at, active=None):
+        """Returns the ids of the Promotions running at the given time, or
+        None when there are more than LIVE_INDEX_MAX_ROWS to index"""
+        with cls.live_index_lock:
+            if not cls._refresh_live_index():
+                return None
+            flags = [True, False] if active is None else [bool(active)]
+            return sorted(promotion_id for flag in flags
+                          for promotion_id in cls.live_index[flag].at(at))
+
+    @classmethod
+    def _refresh_live_index(cls):
+        """Loads the interval index or applies the writes made since
+
+        Returns:
+            False when there are more than LIVE_INDEX_MAX_ROWS Promotions to index
+        """
+        config = cls.app.config if cls.app else {}
+        ttl = config.get("LIVE_INDEX_TTL", 60)
+        columns = (cls.id, cls.start_date, cls.end_date, cls.active)
+        if cls.live_index is None or time.monotonic() - cls.live_index_loaded > ttl:
+            if time.monotonic() < cls.live_index_skipped_until:
+                return False
+            max_rows = config.get("LIVE_INDEX_MAX_ROWS", 100000)
+            if db.session.query(func.count(cls.id)).scalar() > max_rows:
+                logger.warning("Not indexing more than %s date ranges in memory", max_rows)
+                cls.live_index = None
+                cls.live_index_skipped_until = time.monotonic() + ttl
+                return False
+            rows = db.session.query(*columns).all()
+            cls.live_index = {
+                flag: IntervalTree([(row.id, row.start_date, row.end_date)
+                                    for row in rows if row.active == flag])
+                for flag in [True, False]
+            }
+            cls.live_index_loaded = time.monotonic()
+            cls.live_index_pending.clear()
+            return True
+        if not cls.live_index_pending:
+            return True
+        pending = list(cls.live_index_pending)
+        cls.live_index_pending.clear()
+        for tree in cls.live_index.values():
+            for promotion_id in pending:
+                tree.remove(promotion_id)
+        for row in db.session.query(*columns).filter(cls.id.in_(pending)):
+            cls.live_index[row.active].add(row.id, row.start_date, row.end_date)
+        return True
+
+    @classmethod
+    def search_title(cls, title, mode, filters=None, limit=None, fields=None):
+        """Returns the Promotions whose title matches, best match first
+
+        Args:
+            title (string): the text to match, case insensitive
+            mode (string): prefix, substring or fuzzy (trigram similarity)
+            filters (dict): other columns mapped to the values they must equal
+            limit (int): the maximum number of Promotions to return
+            fields (list): only load these columns (and id) from the database
+        """
+        logger.info("Processing %s title search for %s limit %s ...",
+                    mode, title, limit)
+        if mode not in SEARCH_MODES:
+            raise DataValidationError("Invalid title_mode: " + mode)
+        query = cls.find_by_filters(filters or {}, fields=fields)
+        threshold = cls.app.config.get("TITLE_SIMILARITY", 0.3) if cls.app else 0.3
+        if cls.has_trigram_search():
+            return cls._search_title_sql(query, title, mode, threshold) \
+                .limit(limit).all()
+
+        with cls.title_index_lock:
+            indexed = cls._refresh_title_index()
+            # the other filters can only be applied to the rows afterwards
+            promotion_ids = cls.title_index.search(
+                title, mode, None if filters else limit, threshold) if indexed else None
+        if promotion_ids is None:
+            # too many titles to index in every worker, scan the table instead
+            if mode == "fuzzy":
+                raise SearchUnavailableError(
+                    "Fuzzy title searches need the pg_trgm extension on this many promotions")
+            return cls._search_title_sql(query, title, mode, threshold).limit(limit).all()
+        promotions = []
+        batch_size = max(limit or 0, 1000)
+        for start in range(0, len(promotion_ids), batch_size):
+            batch = promotion_ids[start:start + batch_size]
+            found = {promotion.id: promotion
+                     for promotion in query.filter(cls.id.in_(batch))}
+            promotions.extend(found[promotion_id] for promotion_id in batch
+                              if promotion_id in found)
+            if limit is not None and len(promotions) >= limit:
+                break
+        return promotions[:limit]
+
+    @classmethod
+    def has_trigram_search(cls):
+        """Tells whether titles can be searched with PostgreSQL pg_trgm"""
+        if cls.trigram_search is None:
+            cls.trigram_search = db.engine.dialect.name == "postgresql" and \
+                db.session.execute(
+                    "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+                ).scalar() is not None
+        return cls.trigram_search
+
+    @classmethod
+    def _search_title_sql(cls, query, title, mode, threshold):
+        """Applies a title search backed by the pg_trgm GIN index to a query,
+        prefix and substring searches also work, scanning, without it"""
+        pattern = title.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        if mode == "prefix":
+            return query.filter(cls.title.ilike(pattern + "%", escape="\\")).order_by(
+                func.length(cls.title), cls.title, cls.id)
+        if mode == "substring":
+            position = func.instr if db.engine.dialect.name == "sqlite" else func.strpos
+            return query.filter(cls.title.ilike("%" + pattern + "%", escape="\\")).order_by(
+                position(func.lower(cls.title), title.lower()),
+                func.length(cls.title), cls.id)
+        # the % operator only uses the index with the threshold as a setting
+        db.session.execute(
+            "SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)",
+            {"threshold": str(threshold)})
+        # %% is the pg_trgm % operator escaped for the psycopg2 paramstyle
+        return query.filter(cls.title.op("%%")(title)).order_by(
+            cls.title.op("<->")(title), cls.id)
+
+    @classmethod
+    def _refresh_title_index(cls):
+        """Loads the title index or applies the writes made since
+
+        Returns:
+            False when there are more than TITLE_INDEX_MAX_ROWS titles to index
+        """
+        config = cls.app.config if cls.app else {}
+        ttl = config.get("TITLE_INDEX_TTL", 60)
+        columns = (cls.id, cls.title)
+        if cls.title_index is None or time.monotonic() - cls.title_index_loaded > ttl:
+            if time.monotonic() < cls.title_index_skipped_until:
+                return False
+            max_rows = config.get("TITLE_INDEX_MAX_ROWS", 50000)
+            if db.session.query(func.count(cls.id)).scalar() > max_rows:
+                logger.warning("Not indexing more than %s titles in memory", max_rows)
+                cls.title_index = None
+                cls.title_index_skipped_until = time.monotonic() + ttl
+                return False
+            cls.title_index = TrigramIndex(db.session.query(*columns))
+            cls.title_index_loaded = time.monotonic()
+            cls.title_index_pending.clear()
+            return True
+        if not cls.title_index_pending:
+            return True
+        pending = list(cls.title_index_pending)
+        cls.title_index_pending.clear()
+        for promotion_id in pending:
+            cls.title_index.remove(promotion_id)
+        for row in db.session.query(*columns).filter(cls.id.in_(pending)):
+            cls.title_index.add(row.id, row.title)
+        return True
+
+    @classmethod
+    def with_fields(cls, query, fields=None):
+        """Restricts a Promotion query to the given columns
+
+        Args:
+            query (Query): the Promotion query
+            fields (list): the columns to load, the primary key is always loaded
+        """
+        if not fields:
+            return query
+        for name in fields:
+            if name not in cls.FIELDS:
+                raise DataValidationError("Invalid field: " + name)
+        return query.options(load_only(*fields))
+
+    @classmethod
+    def find_after(cls, query, after=None, limit=None):
+        """Returns one page of Promotions using keyset pagination on id
+
+        Args:
+            query (Query): the Promotion query to paginate
+            after (int): cursor, only Promotions with a greater id are returned
+            limit (int): the maximum number of Promotions to return
+        """
+        logger.info("Processing page query after %s limit %s ...",
+                    after, limit)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def stream(cls, query, batch_size=1000, after=None, limit=None):
+        """Returns an iterator over Promotions read from a server-side cursor
+
+        Args:
+            query (Query): the Promotion query to stream
+            batch_size (int): the number of rows fetched per round trip
+            after (int): cursor, only Promotions with a greater id are streamed
+            limit (int): the maximum number of Promotions to stream
+        """
+        logger.info("Processing streamed query in batches of %s after %s limit %s ...",
+                    batch_size, after, limit)
+        query = query.order_by(cls.id)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return (
+            query.limit(limit)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size)
+        )
+
+    @classmethod
+    def from_values(cls, values):
+        """Attaches a Promotion built from column values to the session
+        without querying the database
+
+        Args:
+            values (dict): every column of the Promotion mapped to its value
+        """
+        promotion = cls(**values)
+        make_transient_to_detached(promotion)
+        return db.session.merge(promotion, load=False)
+
+    @classmethod
+    def find(cls, promotion_id, cached=True):
+        """Finds a Promotion by it's ID, from the cache when possible
+
+        Args:
+            promotion_id (int): the id of the Promotion to find
+            cached (boolean): False reads the database, as writes must, since
+                another worker may have changed or deleted the Promotion
+        """
         logger.info("Processing lookup for id %s ...", promotion_id)
-        return cls.query.get(promotion_id)
+        values = cls.cache.get(promotion_id) if cached else None
+        if values is not None:
+            return cls.from_values(values)
+        promotion = cls.query.get(promotion_id)
+        if promotion:
+            cls.cache.set(promotion_id, promotion.snapshot())
+        else:
+            cls.cache.invalidate(promotion_id)
+        return promotion
 
     @classmethod
     def find_or_404(cls, promotion_id):
@@ -195,3 +981,276 @@ class Promotion(db.Model):
         logger.info("Processing active query for %s ...",
                     end_date)
         return cls.query.filter(cls.end_date == end_date)
+
+
+class PromotionSummary(db.Model):
+    """
+    Class that represents the number of Promotions per promotion_type, active
+    flag and month of the start and end dates
+    On PostgreSQL statement triggers on the promotion table keep the counts
+    current in the same transaction as every write, including COPY and the
+    bulk UPDATE and DELETE statements, so reading them never scans the table
+    """
+
+    promotion_type = db.Column(db.String(63), primary_key=True)
+    active = db.Column(db.Boolean(), primary_key=True)
+    start_month = db.Column(db.DateTime(), primary_key=True)
+    end_month = db.Column(db.DateTime(), primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def is_maintained(cls):
+        """Tells whether the database keeps the summary current"""
+        return db.engine.dialect.name == "postgresql"
+
+    @classmethod
+    def groups(cls, exact=False):
+        """Returns (promotion_type, active, start_month, end_month, count) rows
+
+        Args:
+            exact (boolean): count the promotion table instead of the summary
+        """
+        if not exact and cls.is_maintained():
+            return db.session.query(
+                cls.promotion_type, cls.active, cls.start_month, cls.end_month,
+                cls.count).filter(cls.count != 0).all()
+        if db.engine.dialect.name == "postgresql":
+            start = func.date_trunc("month", Promotion.start_date)
+            end = func.date_trunc("month", Promotion.end_date)
+            return db.session.query(
+                Promotion.promotion_type, Promotion.active, start, end, func.count()
+            ).group_by(Promotion.promotion_type, Promotion.active, start, end).all()
+        counts = Counter(
+            (row.promotion_type, row.active, _month(row.start_date), _month(row.end_date))
+            for row in db.session.query(Promotion.promotion_type, Promotion.active,
+                                        Promotion.start_date, Promotion.end_date))
+        return [group + (count,) for group, count in counts.items()]
+
+    @classmethod
+    def stats(cls, exact=False):
+        """Returns the number of Promotions in total, per promotion_type, per
+        active flag and per both, and per month of the start and end dates
+
+        Args:
+            exact (boolean): count the promotion table instead of the summary
+        """
+        logger.info("Processing stats query exact %s ...", exact)
+        by_type, by_type_active = Counter(), {}
+        by_active = Counter({"true": 0, "false": 0})
+        by_start, by_end = Counter(), Counter()
+        for promotion_type, active, start, end, count in cls.groups(exact):
+            flag = "true" if active else "false"
+            by_type[promotion_type] += count
+            by_active[flag] += count
+            by_type_active.setdefault(promotion_type, Counter({"true": 0, "false": 0}))
+            by_type_active[promotion_type][flag] += count
+            by_start[start.strftime("%Y-%m")] += count
+            by_end[end.strftime("%Y-%m")] += count
+        return {
+            "count": sum(by_active.values()),
+            "promotion_type": dict(sorted(by_type.items())),
+            "active": dict(by_active),
+            "promotion_type_active": {
+                name: dict(counts) for name, counts in sorted(by_type_active.items())},
+            "start_date": dict(sorted(by_start.items())),
+            "end_date": dict(sorted(by_end.items())),
+        }
+
+
+def _month(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+# One row of deltas per group touched by a statement, negative for the old
+# rows of an UPDATE or DELETE and positive for the new rows of an INSERT or
+# UPDATE. Installed with the summary table, which is seeded from the
+# promotion table while writes to it wait
+PROMOTION_SUMMARY_DDL = """
+LOCK TABLE promotion IN SHARE ROW EXCLUSIVE MODE;
+CREATE OR REPLACE FUNCTION promotion_summary_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO promotion_summary AS summary
+            (promotion_type, active, start_month, end_month, count)
+        SELECT promotion_type, active, date_trunc('month', start_date),
+               date_trunc('month', end_date), -count(*)
+        FROM old_rows GROUP BY 1, 2, 3, 4
+        ON CONFLICT (promotion_type, active, start_month, end_month)
+        DO UPDATE SET count = summary.count + EXCLUDED.count;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO promotion_summary AS summary
+            (promotion_type, active, start_month, end_month, count)
+        SELECT promotion_type, active, date_trunc('month', start_date),
+               date_trunc('month', end_date), count(*)
+        FROM new_rows GROUP BY 1, 2, 3, 4
+        ON CONFLICT (promotion_type, active, start_month, end_month)
+        DO UPDATE SET count = summary.count + EXCLUDED.count;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS promotion_summary_insert ON promotion;
+DROP TRIGGER IF EXISTS promotion_summary_update ON promotion;
+DROP TRIGGER IF EXISTS promotion_summary_delete ON promotion;
+CREATE TRIGGER promotion_summary_insert AFTER INSERT ON promotion
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE promotion_summary_apply();
+CREATE TRIGGER promotion_summary_update AFTER UPDATE ON promotion
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE promotion_summary_apply();
+CREATE TRIGGER promotion_summary_delete AFTER DELETE ON promotion
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE promotion_summary_apply();
+INSERT INTO promotion_summary (promotion_type, active, start_month, end_month, count)
+SELECT promotion_type, active, date_trunc('month', start_date),
+       date_trunc('month', end_date), count(*)
+FROM promotion GROUP BY 1, 2, 3, 4;
+"""
+
+# the triggers are created on the promotion table, so it must exist first
+PromotionSummary.__table__.add_is_dependent_on(Promotion.__table__)
+event.listen(
+    PromotionSummary.__table__,
+    "after_create",
+    DDL(PROMOTION_SUMMARY_DDL).execute_if(dialect="postgresql"),
+)
+
+
+class PromotionChange(db.Model):
+    """
+    Class that represents a create, update, delete, activation or
+    deactivation of a Promotion in the change log
+    On PostgreSQL statement triggers on the promotion table log one row per
+    Promotion written, numbered from the changes counter of PromotionVersion
+    in the same transaction, so the numbers follow the commit order without
+    gaps, and NOTIFY the promotion_changes channel when it commits
+    """
+
+    ACTIONS = ("create", "update", "delete", "activate", "deactivate")
+    CHANNEL = "promotion_changes"
+
+    seq = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    promotion_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(16), nullable=False)
+    # CURRENT_TIMESTAMP is UTC on SQLite, PROMOTION_CHANGE_DDL sets a UTC
+    # default on PostgreSQL, where it is the local time of the session
+    changed_at = db.Column(db.DateTime(), nullable=False, index=True,
+                           server_default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return "<PromotionChange %s %s id=[%s]>" % (self.seq, self.action, self.promotion_id)
+
+    def serialize(self):
+        """Serializes a change into a dictionary"""
+        return {
+            "seq": self.seq,
+            "promotion_id": self.promotion_id,
+            "action": self.action,
+            "changed_at": isoformat(self.changed_at),
+        }
+
+    @classmethod
+    def is_maintained(cls):
+        """Tells whether the database logs the changes"""
+        return db.engine.dialect.name == "postgresql"
+
+    @classmethod
+    def latest(cls):
+        """Returns the sequence number of the last change, 0 before any"""
+        return db.session.query(PromotionVersion.changes).filter(
+            PromotionVersion.id == 1).scalar() or 0
+
+    @classmethod
+    def find_after(cls, seq, limit=None):
+        """Returns the changes after a sequence number, oldest first
+
+        Args:
+            seq (int): the sequence number of the last change seen
+            limit (int): the maximum number of changes to return
+        """
+        query = cls.query.filter(cls.seq > seq).order_by(cls.seq)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @classmethod
+    def prune(cls, before):
+        """Deletes the changes logged before a moment, returns how many"""
+        count = cls.query.filter(cls.changed_at < before).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+# One row per Promotion written by a statement, numbered after the changes
+# counter, which the statement increments by the number of rows. An UPDATE
+# that only flips the active flag is logged as an activation or deactivation.
+# Installed with the change log table, which an older schema upgrades to by
+# adding the counter column
+PROMOTION_CHANGE_DDL = """
+LOCK TABLE promotion IN SHARE ROW EXCLUSIVE MODE;
+ALTER TABLE promotion_version ADD COLUMN IF NOT EXISTS changes BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE promotion_change ALTER COLUMN changed_at SET DEFAULT timezone('utc', now());
+CREATE OR REPLACE FUNCTION promotion_change_log() RETURNS trigger AS $$
+DECLARE
+    written bigint;
+    first_seq bigint;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT count(*) INTO written FROM new_rows;
+    ELSE
+        SELECT count(*) INTO written FROM old_rows;
+    END IF;
+    IF written = 0 THEN
+        RETURN NULL;
+    END IF;
+    UPDATE promotion_version SET changes = changes + written WHERE id = 1
+        RETURNING changes - written INTO first_seq;
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO promotion_change (seq, promotion_id, action)
+        SELECT first_seq + row_number() OVER (ORDER BY id), id, 'create'
+        FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO promotion_change (seq, promotion_id, action)
+        SELECT first_seq + row_number() OVER (ORDER BY id), id, 'delete'
+        FROM old_rows;
+    ELSE
+        INSERT INTO promotion_change (seq, promotion_id, action)
+        SELECT first_seq + row_number() OVER (ORDER BY new_rows.id), new_rows.id,
+               CASE WHEN old_rows.active = new_rows.active
+                         OR (old_rows.title, old_rows.promotion_type,
+                             old_rows.start_date, old_rows.end_date)
+                            IS DISTINCT FROM (new_rows.title, new_rows.promotion_type,
+                                              new_rows.start_date, new_rows.end_date)
+                    THEN 'update'
+                    WHEN new_rows.active THEN 'activate'
+                    ELSE 'deactivate' END
+        FROM new_rows JOIN old_rows ON old_rows.id = new_rows.id;
+    END IF;
+    PERFORM pg_notify('promotion_changes', (first_seq + written)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS promotion_change_insert ON promotion;
+DROP TRIGGER IF EXISTS promotion_change_update ON promotion;
+DROP TRIGGER IF EXISTS promotion_change_delete ON promotion;
+CREATE TRIGGER promotion_change_insert AFTER INSERT ON promotion
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE promotion_change_log();
+CREATE TRIGGER promotion_change_update AFTER UPDATE ON promotion
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE promotion_change_log();
+CREATE TRIGGER promotion_change_delete AFTER DELETE ON promotion
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE promotion_change_log();
+"""
+
+# the triggers write to both tables, so they must exist first
+PromotionChange.__table__.add_is_dependent_on(Promotion.__table__)
+PromotionChange.__table__.add_is_dependent_on(PromotionVersion.__table__)
+event.listen(
+    PromotionChange.__table__,
+    "after_create",
+    DDL(PROMOTION_CHANGE_DDL).execute_if(dialect="postgresql"),
+)
@@ -0,0 +1,135 @@
+"""
+Trigram Index for Promotion Service
+An in-process index of the trigrams of short strings that answers prefix,
+substring and fuzzy (trigram similarity) searches, for databases without
+the PostgreSQL pg_trgm extension
+"""
+
+import heapq
+from collections import Counter, defaultdict
+from math import ceil
+
+MODES = ("prefix", "substring", "fuzzy")
+
+
+def trigrams(text):
+    """Returns the trigrams of a lower cased string padded like pg_trgm"""
+    padded = "  " + text.lower() + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Class that represents a set of keyed strings indexed by their trigrams
+    Searches are case insensitive and return the keys best match first
+    """
+
+    def __init__(self, items=None):
+        self._texts = {}  # key -> lower cased text
+        self._sizes = {}  # key -> number of trigrams
+        self._postings = defaultdict(set)  # trigram -> keys
+        if items:
+            self.rebuild(items)
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, key):
+        return key in self._texts
+
+    def add(self, key, text):
+        """Adds or replaces the string stored under key"""
+        self.remove(key)
+        text = text.lower()
+        grams = trigrams(text)
+        self._texts[key] = text
+        self._sizes[key] = len(grams)
+        for gram in grams:
+            self._postings[gram].add(key)
+
+    def remove(self, key):
+        """Removes the string stored under key if there is one"""
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        del self._sizes[key]
+        for gram in trigrams(text):
+            keys = self._postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[gram]
+
+    def rebuild(self, items):
+        """Replaces the index with (key, text) tuples"""
+        self._texts = {}
+        self._sizes = {}
+        self._postings = defaultdict(set)
+        for key, text in items:
+            self.add(key, text)
+
+    def search(self, text, mode, limit=None, threshold=0.3):
+        """Returns the keys of the strings that match, best match first
+
+        Args:
+            text (string): the text to search for
+            mode (string): prefix, substring or fuzzy
+            limit (int): the maximum number of keys to return
+            threshold (float): the minimum similarity of a fuzzy match
+        """
+        text = text.lower()
+        if mode == "prefix":
+            padded = "  " + text
+            grams = {padded[i:i + 3] for i in range(len(padded) - 2)}
+            ranked = ((len(value), value, key)
+                      for key, value in self._matches(grams)
+                      if value.startswith(text))
+        elif mode == "substring":
+            grams = {text[i:i + 3] for i in range(len(text) - 2)}
+            ranked = ((value.find(text), len(value), key)
+                      for key, value in self._matches(grams)
+                      if text in value)
+        elif mode == "fuzzy":
+            ranked = self._similar(text, threshold)
+        else:
+            raise ValueError("Unknown search mode: " + mode)
+        if limit is None:
+            return [rank[-1] for rank in sorted(ranked)]
+        return [rank[-1] for rank in heapq.nsmallest(limit, ranked)]
+
+    def _matches(self, grams):
+        """Yields (key, text) of the strings that contain every trigram"""
+        if not grams:
+            yield from self._texts.items()
+            return
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        keys = set(postings[0])
+        for posting in postings[1:]:
+            if not keys:
+                break
+            keys &= posting
+        for key in keys:
+            yield key, self._texts[key]
+
+    def _similar(self, text, threshold):
+        """Yields (-similarity, key) of the strings similar enough to text"""
+        grams = trigrams(text)
+        # a match shares at least `needed` trigrams with the text, so it has
+        # one of the len(grams) - needed + 1 rarest ones
+        needed = max(1, ceil(threshold * len(grams)))
+        ordered = sorted(grams, key=lambda gram: len(self._postings.get(gram, ())))
+        cut = len(grams) - needed + 1
+        counts = Counter()
+        for gram in ordered[:cut]:
+            counts.update(self._postings.get(gram, ()))
+        frequent = [self._postings.get(gram, ()) for gram in ordered[cut:]]
+        for key, shared in counts.items():
+            if shared + len(frequent) < needed:
+                continue
+            for posting in frequent:
+                if key in posting:
+                    shared += 1
+            if shared < needed:
+                continue
+            score = shared / (len(grams) + self._sizes[key] - shared)
+            if score >= threshold:
+                yield -score, key
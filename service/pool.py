@@ -0,0 +1,93 @@
+"""
+Connection Pool for Promotion Service
+A QueuePool that also records how long requests wait to check out a
+database connection, so pool sizing problems can be observed
+"""
+
+import logging
+import threading
+import time
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+# checkouts slower than this are logged together with the pool status
+SLOW_CHECKOUT_SECONDS = 1.0
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Class that represents a QueuePool with checkout wait statistics
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            if waited > SLOW_CHECKOUT_SECONDS:
+                logger.warning("Waited %.3fs for a database connection: %s",
+                               waited, self.status())
+
+    def stats(self):
+        """Returns the pool occupancy and checkout wait statistics"""
+        with self._stats_lock:
+            checkouts = self.checkouts
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "idle": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "max_overflow": self._max_overflow,
+                "checkouts": checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_avg": round(
+                    self.wait_seconds_total / checkouts, 6) if checkouts else 0.0,
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+
+
+def engine_options(config):
+    """Returns SQLAlchemy engine options built from the DB_POOL_* settings
+
+    Args:
+        config (dict): the Flask app configuration
+    """
+    options = dict(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    uri = config.get("SQLALCHEMY_DATABASE_URI") or ""
+    if uri.startswith("sqlite"):
+        return options  # SQLite uses its own single connection pools
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=config.get("DB_POOL_SIZE", 5),
+        max_overflow=config.get("DB_MAX_OVERFLOW", 10),
+        pool_timeout=config.get("DB_POOL_TIMEOUT", 30),
+        pool_recycle=config.get("DB_POOL_RECYCLE", -1),
+        pool_pre_ping=config.get("DB_POOL_PRE_PING", False),
+    )
+    statement_timeout = config.get("DB_STATEMENT_TIMEOUT", 0)
+    if statement_timeout and uri.startswith("postgres"):
+        connect_args = dict(options.get("connect_args", {}))
+        connect_args["options"] = "-c statement_timeout={}".format(
+            statement_timeout)
+        options["connect_args"] = connect_args
+    return options
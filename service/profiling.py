@@ -0,0 +1,94 @@
+"""
+Profiling for Promotion Service
+Wraps a single request in cProfile when PROFILING_ENABLED is set and the
+request carries the PROFILE_HEADER header (X-Profile: 1 by default)
+
+With PROFILE_DIR set the pstats dump is written there (open it with
+snakeviz, flameprof or python -m pstats) next to a JSON file of the SQL
+statements and their timings. Otherwise a short summary is returned in the
+X-Profile-Summary and X-Profile-Sql response headers
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app
+
+SUMMARY_FUNCTIONS = 8
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_sql_timer(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a statement of a profiled request started """
+    if has_request_context() and "profiler" in g:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_sql_timer(conn, cursor, statement, parameters, context, executemany):
+    """ Records how long a statement of a profiled request took """
+    if has_request_context() and "profiler" in g and conn.info.get("profile_started"):
+        elapsed = time.perf_counter() - conn.info["profile_started"].pop()
+        g.profile_sql.append({"seconds": round(elapsed, 6),
+                              "statement": " ".join(statement.split())})
+
+
+@app.before_request
+def start_profiler():
+    """ Starts profiling the request when it asked for it """
+    if not app.config.get("PROFILING_ENABLED"):
+        return
+    if request.headers.get(app.config.get("PROFILE_HEADER", "X-Profile"), "") \
+            .lower() not in ["1", "true"]:
+        return
+    g.profile_sql = []
+    g.profile_started = time.perf_counter()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+@app.after_request
+def stop_profiler(response):
+    """ Writes or summarizes the profile of the request """
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    total = time.perf_counter() - g.profile_started
+    sql_seconds = sum(query["seconds"] for query in g.profile_sql)
+    response.headers["X-Profile-Total-Ms"] = "{:.1f}".format(total * 1000)
+    response.headers["X-Profile-Sql"] = "count={}; total_ms={:.1f}".format(
+        len(g.profile_sql), sql_seconds * 1000)
+
+    directory = app.config.get("PROFILE_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        name = "{}-{}-{}".format(time.strftime("%Y%m%dT%H%M%S"),
+                                 request.endpoint or "unmatched", os.getpid())
+        path = os.path.join(directory, name + ".prof")
+        profiler.dump_stats(path)
+        with open(os.path.join(directory, name + ".sql.json"), "w") as sql_file:
+            json.dump(g.profile_sql, sql_file, indent=2)
+        response.headers["X-Profile-File"] = path
+        app.logger.info("Profile of %s written to %s", request.path, path)
+        return response
+
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.sort_stats("cumulative")
+    summary = []
+    for (filename, line, function), row in stats.stats.items():
+        if filename.startswith("<") or "cProfile" in filename:
+            continue
+        summary.append((row[3], "{}:{}:{}".format(
+            os.path.basename(filename), line, function)))
+    summary.sort(reverse=True)
+    response.headers["X-Profile-Summary"] = "; ".join(
+        "{}={:.1f}ms".format(name, seconds * 1000)
+        for seconds, name in summary[:SUMMARY_FUNCTIONS])
+    return response
@@ -3,25 +3,44 @@ Promotion  Service
 Paths:
 ------
 GET /promotions - Returns a list all of the Promotions
+GET /promotions?limit={n}&after={id} - Returns one page of Promotions after a cursor
+GET /promotions?stream=true - Streams the list of Promotions
+GET /promotions?{filter}={value}&sort={field} - Returns the Promotions matching all filters
+GET /promotions?title={text}&title_mode=prefix|substring|fuzzy - Returns the best title matches
+GET /promotions?start_after={timestamp}&end_before={timestamp} - Returns the Promotions in date ranges
+GET /promotions/export?format=ndjson|csv - Streams every Promotion as NDJSON or CSV
+GET /promotions/live?at={timestamp} - Returns the Promotions running at a time
+GET /promotions/live?at={timestamp}&limit={n}&after={id} - Returns one page of them
+GET /promotions/stats - Returns the number of Promotions by type, active flag and month
+GET /promotions/changes - Streams the changes to Promotions as Server-Sent Events (see changes.py)
 GET /promotions/{id} - Returns the Promotion with a given id number
+GET /promotions?fields=id,title - Returns only the given fields (also on /live and /{id})
 POST /promotions - creates a new Promotion record in the database
+POST /promotions/bulk - creates many Promotion records in batches
 PUT /promotions/{id} - updates a Promotion record in the database
+PATCH /promotions/{id} - updates only the fields sent of a Promotion record
 DELETE /promotions/{id} - deletes a Promotion record in the database
+DELETE /promotions - deletes the Promotions with the given ids or filters, or all=true
 PUT /promotions/{id}/activate - activates a Promotion with a given id number
 PUT /promotions/{id}/deactivate - deactivates a Promotion with a given id number
+PUT /promotions/activate - activates the Promotions with the given ids or filters
+PUT /promotions/deactivate - deactivates the Promotions with the given ids or filters
+GET /cache - Returns the hit/miss counters of the Promotion cache
+GET /pool - Returns the database connection pool occupancy and wait times
+GET /metrics - Returns request metrics in the Prometheus format (see metrics.py)
 """
 
-import os
-import sys
-import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import io
+import csv
+from datetime import datetime, timezone
+from flask import jsonify, request, url_for, make_response, abort
+from flask import Response, json, stream_with_context
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
 
-# For this example we'll use SQLAlchemy, a popular ORM that supports a
-# variety of backends including SQLite, MySQL, and PostgreSQL
-from flask_sqlalchemy import SQLAlchemy
-from service.models import Promotion, DataValidationError
+from service.models import db, Promotion, PromotionSummary, PromotionVersion, DataValidationError
+from service.encoding import dumps, isoformat, json_response
+from service.compression import send_static_compressed
 
 # Import Flask application
 from . import app
@@ -34,7 +53,7 @@ from . import app
 @app.route("/")
 def index():
     """ Root URL response """
-    return app.send_static_file("index.html")
+    return send_static_compressed("index.html")
 
 ######################################################################
 # LIST ALL PROMOTIONS
@@ -43,27 +62,225 @@ def index():
 
 @app.route("/promotions", methods=["GET"])
 def list_promotions():
-    """ Returns all of the Promotions """
+    """
+    Returns all of the Promotions
+    Responses carry an ETag of the table version so If-None-Match gets 304.
+    Every filter sent is applied and sort orders by any filterable field.
+    Pass limit and/or after to page through the results by id, or
+    stream=true to stream the JSON array from a server-side cursor, up to
+    limit Promotions after the after cursor when they are sent.
+    fields selects the columns that are read and returned. title_mode
+    matches the title by prefix, substring or similarity instead, and
+    returns up to limit Promotions best match first
+    """
     app.logger.info("Request for promotion list")
-    promotions = []
-    promotion_type = request.args.get("promotion_type")
-    active = request.args.get("active")
-    title = request.args.get("title")
-    end_date = request.args.get("end_date")
-
-    if promotion_type:
-        promotions = Promotion.find_by_promotiontype(promotion_type)
-    elif active:
-        promotions = Promotion.find_by_active(active)
-    elif title:
-        promotions = Promotion.find_by_title(title)
-    elif end_date:
-        promotions = Promotion.find_by_end_date(end_date)
+    filters = get_filter_args()
+    fields = get_fields_arg()
+    sort = request.args.get("sort")
+    limit = get_int_arg("limit", minimum=1)
+    after = get_int_arg("after")
+    title_mode = request.args.get("title_mode", "exact")
+    if sort and after is not None:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "after cannot be combined with sort")
+    if title_mode not in Promotion.TITLE_MODES:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid title_mode: " + title_mode)
+    search = title_mode != "exact" and "title" in filters
+    if search and (sort or after is not None or get_bool_arg("stream")):
+        abort(status.HTTP_400_BAD_REQUEST,
+              "title_mode results are ranked, they cannot be sorted, paged or streamed")
+
+    # the list can only differ when the table-level counter has moved
+    etag = "v{}".format(PromotionVersion.current())
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    if search:
+        limit = min(limit or app.config["PAGE_SIZE_DEFAULT"],
+                    app.config["PAGE_SIZE_MAX"])
+        promotions = Promotion.search_title(
+            filters.pop("title"), title_mode, filters, limit, fields)
+        results = [promotion.serialize(fields) for promotion in promotions]
+        response = json_response(results, status.HTTP_200_OK)
+        response.set_etag(etag)
+        return response
+
+    if get_bool_arg("stream"):
+        # limit and after bound the whole stream, which is not paged
+        promotions = Promotion.find_by_filters(filters, sort, fields=fields)
+        response = stream_promotions(Promotion.stream(
+            promotions, app.config["STREAM_BATCH_SIZE"], after, limit), fields)
+        response.set_etag(etag)
+        return response
+
+    # a sorted list is limited by the query itself instead of a cursor
+    sorted_limit = None
+    if sort and limit is not None:
+        sorted_limit = min(limit, app.config["PAGE_SIZE_MAX"])
+    promotions = Promotion.find_by_filters(filters, sort, sorted_limit, fields)
+
+    if sort or (limit is None and after is None):
+        results = [promotion.serialize(fields) for promotion in promotions]
+        response = json_response(results, status.HTTP_200_OK)
+        response.set_etag(etag)
+        return response
+
+    limit = min(limit or app.config["PAGE_SIZE_DEFAULT"],
+                app.config["PAGE_SIZE_MAX"])
+    promotions = Promotion.find_after(promotions, after, limit)
+    results = [promotion.serialize(fields) for promotion in promotions]
+    headers = next_page_headers("list_promotions", promotions, limit)
+    response = json_response(results, status.HTTP_200_OK, headers)
+    response.set_etag(etag)
+    return response
+
+
+def next_page_headers(endpoint, promotions, limit):
+    """ Returns the Link and X-Next-Cursor headers of a full page """
+    headers = {}
+    if limit is not None and len(promotions) == limit:
+        cursor = promotions[-1].id
+        args = request.args.to_dict()
+        args.update(after=cursor, limit=limit)
+        next_url = url_for(endpoint, _external=True, **args)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        headers["X-Next-Cursor"] = str(cursor)
+    return headers
+
+
+def stream_promotions(promotions, fields=None):
+    """ Streams Promotions as a JSON array a chunk of rows at a time """
+    chunk_size = app.config["STREAM_BATCH_SIZE"]
+
+    def generate():
+        yield b"["
+        chunk = []
+        for count, promotion in enumerate(promotions):
+            if count:
+                chunk.append(b",")
+            chunk.append(dumps(promotion.serialize(fields)))
+            if len(chunk) >= chunk_size:
+                yield b"".join(chunk)
+                chunk = []
+        chunk.append(b"]")
+        yield b"".join(chunk)
+
+    return Response(stream_with_context(generate()),
+                    status=status.HTTP_200_OK, mimetype="application/json")
+
+######################################################################
+# EXPORT PROMOTIONS
+######################################################################
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+@app.route("/promotions/export", methods=["GET"])
+def export_promotions():
+    """
+    Exports Promotions as newline delimited JSON or CSV
+    Rows are streamed from a server-side cursor a chunk at a time, and the
+    same filters as the list endpoint apply
+    """
+    app.logger.info("Request to export promotions")
+    export_format = request.args.get("format", "ndjson").lower()
+    if export_format not in EXPORT_FORMATS:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "format must be one of {}".format(", ".join(EXPORT_FORMATS)))
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+    promotions = Promotion.stream(
+        Promotion.find_by_filters(get_filter_args()), batch_size)
+    if export_format == "csv":
+        rows = export_csv(promotions, batch_size)
     else:
-        promotions = Promotion.all()
+        rows = export_ndjson(promotions, batch_size)
+    return Response(
+        stream_with_context(rows),
+        status=status.HTTP_200_OK,
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition":
+                 "attachment; filename=promotions." + export_format},
+    )
+
+
+def export_ndjson(promotions, chunk_size):
+    """ Yields chunks of Promotions serialized one JSON object per line """
+    chunk = []
+    for promotion in promotions:
+        chunk.append(dumps(promotion.serialize()) + b"\n")
+        if len(chunk) >= chunk_size:
+            yield b"".join(chunk)
+            chunk = []
+    yield b"".join(chunk)
+
+
+def export_csv(promotions, chunk_size):
+    """ Yields chunks of Promotions as CSV rows, starting with a header row """
+    columns = [column.name for column in Promotion.__table__.columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, promotion in enumerate(promotions, 1):
+        row = promotion.serialize()
+        writer.writerow([
+            isoformat(row[name]) if isinstance(row[name], datetime) else row[name]
+            for name in columns
+        ])
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+######################################################################
+# LIST LIVE PROMOTIONS
+######################################################################
+
+
+@app.route("/promotions/live", methods=["GET"])
+def list_live_promotions():
+    """
+    Returns the Promotions running at a point in time
+    at defaults to now, and active narrows the result to that active flag.
+    Pass limit and/or after to page through them by id
+    """
+    app.logger.info("Request for live promotion list")
+    at = get_datetime_arg("at") or datetime.utcnow()
+    fields = get_fields_arg()
+    limit = get_int_arg("limit", minimum=1)
+    after = get_int_arg("after")
+    if limit is not None or after is not None:
+        limit = min(limit or app.config["PAGE_SIZE_DEFAULT"],
+                    app.config["PAGE_SIZE_MAX"])
+    promotions = Promotion.find_live(at, get_bool_arg("active"), fields, after, limit)
+    results = [promotion.serialize(fields) for promotion in promotions]
+    headers = next_page_headers("list_live_promotions", promotions, limit)
+    return json_response(results, status.HTTP_200_OK, headers)
+
+######################################################################
+# PROMOTION STATISTICS
+######################################################################
+
 
-    results = [promotion.serialize() for promotion in promotions]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+@app.route("/promotions/stats", methods=["GET"])
+def get_promotion_stats():
+    """
+    Returns the number of Promotions by promotion_type, active flag and
+    month of the start and end dates
+    The counts come from a summary table that every write keeps current,
+    exact=true counts the promotion table instead to verify them
+    """
+    app.logger.info("Request for promotion stats")
+    exact = bool(get_bool_arg("exact"))
+    etag = "v{}{}".format(PromotionVersion.current(), "-exact" if exact else "")
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    response = json_response(PromotionSummary.stats(exact), status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
 
 ######################################################################
 # RETRIEVE A PROMOTION
@@ -74,14 +291,22 @@ def list_promotions():
 def get_promotions(promotion_id):
     """
     Retrieve a single Promotion
-    This endpoint will return a Promotion based on it's id
+    This endpoint will return a Promotion based on it's id, or 304 when
+    the If-None-Match header carries its current ETag. The whole row comes
+    from the cache, fields only trims what is returned
     """
     app.logger.info("Request for promotion with id: %s", promotion_id)
+    fields = get_fields_arg()
     promotion = Promotion.find(promotion_id)
     if not promotion:
         raise NotFound(
             "Promotion with id '{}' was not found.".format(promotion_id))
-    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+    etag = promotion.etag()
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    response = json_response(promotion.serialize(fields), status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
 
 ######################################################################
 # ADD A NEW PROMOTION
@@ -102,10 +327,88 @@ def create_promotions():
     message = promotion.serialize()
     location_url = url_for(
         "get_promotions", promotion_id=promotion.id, _external=True)
-    return make_response(
-        jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    return json_response(
+        message, status.HTTP_201_CREATED, {"Location": location_url}
     )
 
+######################################################################
+# ADD PROMOTIONS IN BULK
+######################################################################
+
+
+@app.route("/promotions/bulk", methods=["POST"])
+def create_promotions_bulk():
+    """
+    Creates Promotions in bulk
+    The body is a JSON array or newline delimited JSON (application/x-ndjson).
+    Rows are validated one by one and inserted batch_size at a time, and the
+    response reports the new id or the error of every row
+    """
+    app.logger.info("Request to create promotions in bulk")
+    batch_size = get_int_arg("batch_size", minimum=1) or \
+        app.config["BULK_BATCH_SIZE"]
+    content_type = request.headers.get("Content-Type", "").split(";")[0]
+    if content_type == "application/json":
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            raise DataValidationError(
+                "Invalid request: body must be a JSON array of promotions")
+    elif content_type == "application/x-ndjson":
+        rows = read_ndjson(request.stream)
+    else:
+        check_content_type("application/json")
+
+    results = []
+    batch = []
+    for index, row in enumerate(rows):
+        try:
+            if isinstance(row, Exception):
+                raise row
+            batch.append((index, Promotion().deserialize(row)))
+        except (DataValidationError, ValueError) as error:
+            results.append({"index": index, "error": str(error)})
+        if len(batch) >= batch_size:
+            results.extend(create_batch(batch, batch_size))
+            batch = []
+    results.extend(create_batch(batch, batch_size))
+    results.sort(key=lambda result: result["index"])
+
+    created = sum(1 for result in results if "id" in result)
+    app.logger.info("Created %s of %s promotions in bulk", created, len(results))
+    message = {
+        "created": created,
+        "failed": len(results) - created,
+        "results": results,
+    }
+    return make_response(jsonify(message), status.HTTP_201_CREATED)
+
+
+def create_batch(batch, batch_size):
+    """ Creates a batch of (index, Promotion) pairs and returns their results """
+    if not batch:
+        return []
+    ids, errors = Promotion.create_many(
+        [promotion for _, promotion in batch], batch_size)
+    results = []
+    for position, (index, _) in enumerate(batch):
+        if position in errors:
+            results.append({"index": index, "error": errors[position]})
+        else:
+            results.append({"index": index, "id": ids[position]})
+    return results
+
+
+def read_ndjson(stream):
+    """ Yields one parsed JSON value per line, or the ValueError it raised """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield ValueError("Invalid promotion: malformed JSON ({})".format(error))
+
 ######################################################################
 # UPDATE AN EXISTING PROMOTION
 ######################################################################
@@ -119,16 +422,42 @@ def update_promotions(promotion_id):
     """
     app.logger.info("Request to update promotion with id: %s", promotion_id)
     check_content_type("application/json")
-    promotion = Promotion.find(promotion_id)
+    promotion = Promotion.find(promotion_id, cached=False)
     if not promotion:
         raise NotFound(
             "Promotion with id '{}' was not found.".format(promotion_id))
     promotion.deserialize(request.get_json())
     promotion.id = promotion_id
-    promotion.update()
+    if not promotion.update():
+        raise NotFound(
+            "Promotion with id '{}' was not found.".format(promotion_id))
 
     app.logger.info("Promotion with ID [%s] updated.", promotion.id)
-    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+    return json_response(promotion.serialize(), status.HTTP_200_OK)
+
+######################################################################
+# UPDATE SOME FIELDS OF A PROMOTION
+######################################################################
+
+
+@app.route("/promotions/<int:promotion_id>", methods=["PATCH"])
+def patch_promotions(promotion_id):
+    """
+    Update some fields of a Promotion
+    This endpoint will change only the fields in the body with one UPDATE
+    statement and return the whole Promotion with its new ETag
+    """
+    app.logger.info("Request to patch promotion with id: %s", promotion_id)
+    check_content_type("application/json")
+    promotion = Promotion.patch(promotion_id, request.get_json())
+    if not promotion:
+        raise NotFound(
+            "Promotion with id '{}' was not found.".format(promotion_id))
+
+    app.logger.info("Promotion with ID [%s] patched.", promotion_id)
+    response = json_response(promotion.serialize(), status.HTTP_200_OK)
+    response.set_etag(promotion.etag())
+    return response
 
 ######################################################################
 # DELETE A PROMOTION
@@ -142,13 +471,29 @@ def delete_promotions(promotion_id):
     This endpoint will delete a Promotion based the id specified in the path
     """
     app.logger.info("Request to delete promotion with id: %s", promotion_id)
-    promotion = Promotion.find(promotion_id)
-    if promotion:
-        promotion.delete()
+    Promotion.delete_many([promotion_id])
 
     app.logger.info("Promotion with ID [%s] delete complete.", promotion_id)
     return make_response("", status.HTTP_204_NO_CONTENT)
 
+
+@app.route("/promotions", methods=["DELETE"])
+def delete_promotions_bulk():
+    """
+    Delete many Promotions
+    This endpoint will delete the Promotions with the ids in the body and/or
+    matching the list filters, or every Promotion with all=true
+    """
+    app.logger.info("Request to delete promotions in bulk")
+    promotion_ids = get_ids_body()
+    filters = get_filter_args()
+    if promotion_ids is None and not filters and not get_bool_arg("all"):
+        abort(status.HTTP_400_BAD_REQUEST,
+              "Send a list of ids, at least one filter or all=true")
+    count = Promotion.delete_many(promotion_ids, filters)
+    app.logger.info("Deleted %s promotions", count)
+    return make_response(jsonify(deleted=count), status.HTTP_200_OK)
+
 ######################################################################
 # ACTIVATE AN EXISTING PROMOTION
 ######################################################################
@@ -164,15 +509,17 @@ def activate_promotions(promotion_id):
 
     check_content_type("application/json")
 
-    promotion = Promotion.find(promotion_id)
+    promotion = Promotion.find(promotion_id, cached=False)
     if not promotion:
         raise NotFound(
             "Promotion with id '{}' was not found.".format(promotion_id))
     promotion.active = True
-    promotion.update()
+    if not promotion.update():
+        raise NotFound(
+            "Promotion with id '{}' was not found.".format(promotion_id))
 
     app.logger.info("Promotion with ID [%s] updated.", promotion.id)
-    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+    return json_response(promotion.serialize(), status.HTTP_200_OK)
 
 ######################################################################
 # DEACTIVATE AN EXISTING PROMOTION
@@ -190,15 +537,83 @@ def deactivate_promotions(promotion_id):
 
     check_content_type("application/json")
 
-    promotion = Promotion.find(promotion_id)
+    promotion = Promotion.find(promotion_id, cached=False)
     if not promotion:
         raise NotFound(
             "Promotion with id '{}' was not found.".format(promotion_id))
     promotion.active = False
-    promotion.update()
+    if not promotion.update():
+        raise NotFound(
+            "Promotion with id '{}' was not found.".format(promotion_id))
 
     app.logger.info("Promotion with ID [%s] updated.", promotion.id)
-    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+    return json_response(promotion.serialize(), status.HTTP_200_OK)
+
+######################################################################
+# CACHE STATISTICS
+######################################################################
+
+
+@app.route("/cache", methods=["GET"])
+def get_cache_stats():
+    """ Returns the size and hit/miss counters of the Promotion cache """
+    app.logger.info("Request for cache statistics")
+    return make_response(jsonify(Promotion.cache.stats()), status.HTTP_200_OK)
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+
+
+@app.route("/pool", methods=["GET"])
+def get_pool_stats():
+    """ Returns the database connection pool occupancy and wait times """
+    app.logger.info("Request for connection pool statistics")
+    pool = db.engine.pool
+    if hasattr(pool, "stats"):
+        stats = pool.stats()
+    else:
+        stats = {"status": pool.status()}
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+######################################################################
+# ACTIVATE OR DEACTIVATE PROMOTIONS IN BULK
+######################################################################
+
+
+@app.route("/promotions/activate", methods=["PUT"])
+def activate_promotions_bulk():
+    """
+    Activate many Promotions
+    This endpoint will activate the Promotions with the ids in the body
+    and/or matching the same query parameters as the list endpoint
+    """
+    app.logger.info("Request to activate promotions in bulk")
+    return set_active_bulk(True)
+
+
+@app.route("/promotions/deactivate", methods=["PUT"])
+def deactivate_promotions_bulk():
+    """
+    Deactivate many Promotions
+    This endpoint will deactivate the Promotions with the ids in the body
+    and/or matching the same query parameters as the list endpoint
+    """
+    app.logger.info("Request to deactivate promotions in bulk")
+    return set_active_bulk(False)
+
+
+def set_active_bulk(active):
+    """ Sets the active flag of the selected Promotions in one statement """
+    check_content_type("application/json")
+    promotion_ids = get_ids_body()
+    filters = get_filter_args()
+    if promotion_ids is None and not filters:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "Send a list of ids or at least one filter")
+    count = Promotion.set_active(active, promotion_ids, filters)
+    app.logger.info("Set active to %s for %s promotions", active, count)
+    return make_response(jsonify(updated=count), status.HTTP_200_OK)
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -211,6 +626,92 @@ def init_db():
     Promotion.init_db(app)
 
 
+def not_modified(etag):
+    """ Returns an empty 304 Not Modified response carrying the ETag """
+    app.logger.info("Resource not modified since ETag %s", etag)
+    response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def get_filter_args():
+    """ Returns the Promotion filters sent as query parameters """
+    filters = {}
+    for name in ["promotion_type", "title", "end_date"]:
+        if request.args.get(name):
+            filters[name] = request.args.get(name)
+    if request.args.get("active"):
+        filters["active"] = get_bool_arg("active")
+    for name in Promotion.RANGES:
+        moment = get_datetime_arg(name)
+        if moment is not None:
+            filters[name] = moment
+    return filters
+
+
+def get_fields_arg():
+    """ Returns the list of fields sent in the fields query parameter or None """
+    value = request.args.get("fields")
+    if not value:
+        return None
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    for name in names:
+        if name not in Promotion.FIELDS:
+            raise DataValidationError("Invalid field: " + name)
+    return [name for name in Promotion.FIELDS if name in names]
+
+
+def get_ids_body():
+    """ Returns the list of ids sent in the JSON body or None """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict) or data.get("ids") is None:
+        return None
+    promotion_ids = data["ids"]
+    if not isinstance(promotion_ids, list) or not all(
+            isinstance(promotion_id, int) and not isinstance(promotion_id, bool)
+            for promotion_id in promotion_ids):
+        raise DataValidationError("Invalid request: ids must be a list of integers")
+    return promotion_ids
+
+
+def get_bool_arg(name):
+    """ Returns a boolean query parameter or None if it was not sent """
+    value = request.args.get(name)
+    if not value:
+        return None
+    return value.lower() in ["true", "1"]
+
+
+def get_datetime_arg(name):
+    """ Returns an ISO 8601 query parameter as a naive UTC datetime or None """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "{} must be an ISO 8601 date or timestamp".format(name))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def get_int_arg(name, minimum=0):
+    """ Returns an integer query parameter or None if it was not sent """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "{} must be an integer >= {}".format(name, minimum))
+    return number
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if "Content-Type" in request.headers and request.headers["Content-Type"] == content_type:
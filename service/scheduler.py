@@ -0,0 +1,197 @@
+"""
+Promotion Scheduler
+Keeps the active flag of Promotions in line with their start and end dates,
+so clients do not have to activate and deactivate them one at a time
+
+The start and end dates due within SCHEDULER_HORIZON seconds are kept in a
+heap, and the scheduler sleeps until the first of them, or for at most
+SCHEDULER_INTERVAL seconds to pick up the writes of other processes. Each
+tick flips every Promotion due since the last one with a single UPDATE per
+direction, under a PostgreSQL advisory lock, so every gunicorn worker can
+run a scheduler thread and only one of them applies each tick. The process
+that applies a tick also prunes the change log of the changes older than
+CHANGES_RETENTION seconds
+
+Usage:
+    flask scheduler run
+    flask scheduler tick
+"""
+
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from flask.cli import AppGroup
+from service.models import db, Promotion, PromotionChange
+from service.routes import init_db
+from . import app
+
+
+class Scheduler:
+    """
+    Class that represents a time-ordered queue of upcoming start and end
+    dates and the thread that applies them
+    """
+
+    def __init__(self, interval=60, horizon=3600):
+        self.interval = interval
+        self.horizon = horizon
+        self._due = []  # heap of upcoming start and end dates
+        self._loaded_until = None  # dates up to it are in the heap
+        self._pending = set()  # ids written since the heap was refreshed
+        self._last_tick = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def configure(self, interval, horizon):
+        """Sets the longest sleep and how far ahead dates are queued, in seconds"""
+        self.interval = interval
+        self.horizon = horizon
+
+    def notify(self, promotion_ids=None):
+        """Queues the dates of written Promotions, or of all of them for None"""
+        with self._lock:
+            # past a few thousand writes a reload is cheaper than a lookup
+            if promotion_ids is None or \
+                    len(self._pending) + len(promotion_ids) > 10000:
+                self._loaded_until = None
+                self._pending.clear()
+            else:
+                self._pending.update(promotion_ids)
+        self._wake.set()
+
+    def refresh(self, now):
+        """Loads the dates due within the horizon, or the dates of the
+        Promotions written since the last refresh"""
+        with self._lock:
+            reload = self._loaded_until is None or now >= self._loaded_until
+            pending, self._pending = self._pending, set()
+        if reload:
+            until = now + timedelta(seconds=self.horizon)
+            due = Promotion.find_boundaries(now, until)  # already sorted
+            with self._lock:
+                self._due = due
+                self._loaded_until = until
+        elif pending:
+            due = Promotion.find_boundaries(now, self._loaded_until, list(pending))
+            with self._lock:
+                for moment in due:
+                    heapq.heappush(self._due, moment)
+
+    def is_due(self, now):
+        """Tells whether a queued date has passed or a tick is overdue"""
+        if self._last_tick is None or \
+                time.monotonic() - self._last_tick >= self.interval:
+            return True
+        with self._lock:
+            return bool(self._due) and self._due[0] <= now
+
+    def tick(self, now=None):
+        """Applies the schedule up to now and drops the dates that passed
+
+        Returns:
+            (activated ids, deactivated ids), or None when another process
+            is applying the schedule
+        """
+        now = now or datetime.utcnow()
+        result = Promotion.apply_schedule(now)
+        if result is not None and PromotionChange.is_maintained():
+            PromotionChange.prune(
+                now - timedelta(seconds=app.config.get("CHANGES_RETENTION", 604800)))
+        self._last_tick = time.monotonic()
+        with self._lock:
+            while self._due and self._due[0] <= now:
+                heapq.heappop(self._due)
+        return result
+
+    def next_wake(self, now):
+        """Returns the seconds until the next queued date or tick"""
+        wake = now + timedelta(seconds=self.interval)
+        with self._lock:
+            if self._due:
+                wake = min(wake, self._due[0])
+            if self._loaded_until is not None:
+                wake = min(wake, self._loaded_until)
+        return max(0.0, (wake - now).total_seconds())
+
+    def run(self):
+        """Applies the schedule as dates come due until stop() is called"""
+        while not self._stopping.is_set():
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    now = datetime.utcnow()
+                    self.refresh(now)
+                    if self.is_due(now):
+                        self.tick(now)
+                    delay = self.next_wake(datetime.utcnow())
+                except Exception:  # pylint: disable=broad-except
+                    app.logger.exception("Scheduler tick failed")
+                    db.session.rollback()
+                    delay = self.interval
+                finally:
+                    db.session.remove()
+            self._wake.wait(delay)
+
+    def start(self):
+        """Runs the scheduler in a daemon thread of this process"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.configure(app.config.get("SCHEDULER_INTERVAL", 60),
+                       app.config.get("SCHEDULER_HORIZON", 3600))
+        self._stopping.clear()
+        self._loaded_until = None
+        Promotion.change_listeners.append(self.notify)
+        self._thread = threading.Thread(
+            target=self.run, name="promotion-scheduler", daemon=True)
+        self._thread.start()
+        app.logger.info("Scheduler started")
+
+    def stop(self, timeout=None):
+        """Stops the scheduler thread and waits for it to finish"""
+        if self.notify in Promotion.change_listeners:
+            Promotion.change_listeners.remove(self.notify)
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+scheduler = Scheduler()
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+
+scheduler_cli = AppGroup("scheduler", help="Apply the start and end dates of promotions.")
+
+
+@scheduler_cli.command("tick")
+def tick_command():
+    """Activate and deactivate the promotions due since the last tick."""
+    init_db()
+    result = scheduler.tick()
+    if result is None:
+        click.echo("Another process is applying the schedule")
+        return
+    click.echo("Activated {} and deactivated {} promotions".format(
+        len(result[0]), len(result[1])))
+
+
+@scheduler_cli.command("run")
+def run_command():
+    """Apply the start and end dates of promotions until interrupted."""
+    init_db()
+    scheduler.configure(app.config.get("SCHEDULER_INTERVAL", 60),
+                        app.config.get("SCHEDULER_HORIZON", 3600))
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+
+app.cli.add_command(scheduler_cli)
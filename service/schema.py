@@ -0,0 +1,118 @@
+"""
+Schema Management for Promotion Service
+Creates and upgrades the database schema in one shot, outside of the
+service start, and checks it with a single query when the service starts
+
+Usage:
+    flask schema upgrade
+    flask schema check
+
+Bump SCHEMA_VERSION whenever a table, column or index is added or dropped,
+so workers started against an older database upgrade it or refuse to start
+"""
+
+import sys
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import db, Promotion, SchemaVersion
+from service.routes import init_db
+from . import app
+
+SCHEMA_VERSION = 6
+
+# Indexes older versions created that are no longer wanted, by table
+DROPPED_INDEXES = {
+    # the leading column of ix_promotion_type_active
+    "promotion": ["ix_promotion_promotion_type"],
+}
+
+
+def upgrade_schema():
+    """ Creates the missing tables and indexes, drops the DROPPED_INDEXES and
+    stamps SCHEMA_VERSION """
+    app.logger.info("Upgrading the database schema to version %s", SCHEMA_VERSION)
+    db.create_all()
+    # create_all skips tables that exist, so add the indexes they are missing
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                app.logger.info("Creating index %s", index.name)
+                index.create(db.engine)
+        for name in DROPPED_INDEXES.get(table.name, []):
+            if name in existing:
+                app.logger.info("Dropping index %s", name)
+                db.engine.execute("DROP INDEX {}".format(name))
+    create_trigram_index()
+    SchemaVersion.stamp(SCHEMA_VERSION)
+    db.session.commit()
+
+
+def create_trigram_index():
+    """ Indexes the titles for searches with pg_trgm when PostgreSQL has it """
+    if db.engine.dialect.name != "postgresql":
+        return
+    try:
+        with db.engine.begin() as connection:
+            connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_promotion_title_trgm "
+                "ON promotion USING gin (title gin_trgm_ops)")
+    except SQLAlchemyError as error:
+        app.logger.warning(
+            "Cannot create the pg_trgm title index, title searches use an "
+            "in-memory index: %s", str(error.orig).splitlines()[0])
+    Promotion.trigram_search = None
+
+
+def check_schema(upgrade=False):
+    """
+    Checks that the database schema is at SCHEMA_VERSION
+
+    Args:
+        upgrade (boolean): upgrade an older schema instead of failing
+
+    Raises:
+        RuntimeError: when the schema is not current and upgrade is False
+    """
+    version = SchemaVersion.current()
+    if version == SCHEMA_VERSION:
+        return
+    if not upgrade:
+        raise RuntimeError(
+            "Database schema is at version {} but {} is required, "
+            "run flask schema upgrade".format(version, SCHEMA_VERSION))
+    upgrade_schema()
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+
+schema_cli = AppGroup("schema", help="Manage the database schema.")
+
+
+@schema_cli.command("upgrade")
+def upgrade_command():
+    """Create or upgrade the database schema."""
+    init_db()
+    upgrade_schema()
+    click.echo("Database schema is at version {}".format(SCHEMA_VERSION))
+
+
+@schema_cli.command("check")
+def check_command():
+    """Exit with status 1 unless the database schema is current."""
+    init_db()
+    try:
+        check_schema()
+    except RuntimeError as error:
+        click.echo(str(error), err=True)
+        sys.exit(1)
+    click.echo("Database schema is at version {}".format(SCHEMA_VERSION))
+
+
+app.cli.add_command(schema_cli)
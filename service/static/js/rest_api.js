@@ -263,7 +263,7 @@ $(function () {
         var queryString = ""
 
         if (title) {
-            queryString += 'title=' + title
+            queryString += 'title=' + encodeURIComponent(title) + '&title_mode=substring'
         }
         if (type) {
             if (queryString.length > 0) {
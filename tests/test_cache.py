@@ -0,0 +1,58 @@
+"""
+Test cases for the Promotion cache
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import time
+import unittest
+from service.cache import LRUCache
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+
+
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for LRUCache """
+
+    def test_get_and_set(self):
+        """ Store a value and read it back """
+        cache = LRUCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, "one")
+        self.assertEqual(cache.get(1), "one")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "one")
+        self.assertEqual(cache.get(3), "three")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expires_entries(self):
+        """ Treat entries older than the ttl as misses """
+        cache = LRUCache(maxsize=2, ttl=0.01)
+        cache.set(1, "one")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_disable(self):
+        """ Invalidate an entry and disable the cache """
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, "one")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        cache.configure(0, 60)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
@@ -0,0 +1,62 @@
+"""
+Test cases for the Promotion interval index
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import random
+import unittest
+from datetime import datetime, timedelta
+from service.intervals import IntervalTree
+
+######################################################################
+#  I N T E R V A L   T R E E   T E S T   C A S E S
+######################################################################
+
+
+class TestIntervalTree(unittest.TestCase):
+    """ Test Cases for IntervalTree """
+
+    def test_at(self):
+        """ Find the intervals containing a point """
+        tree = IntervalTree([(1, 0, 10), (2, 5, 15), (3, 20, 30)])
+        self.assertEqual(sorted(tree.at(5)), [1, 2])
+        self.assertEqual(sorted(tree.at(10)), [2])
+        self.assertEqual(sorted(tree.at(17)), [])
+        self.assertEqual(sorted(tree.at(20)), [3])
+
+    def test_add_and_remove(self):
+        """ Add, move and remove intervals one at a time """
+        tree = IntervalTree()
+        tree.add(1, 0, 10)
+        tree.add(2, 5, 15)
+        tree.add(1, 12, 20)
+        self.assertEqual(sorted(tree.at(5)), [2])
+        self.assertEqual(sorted(tree.at(13)), [1, 2])
+        tree.remove(2)
+        tree.remove(99)
+        self.assertEqual(sorted(tree.at(13)), [1])
+        self.assertNotIn(2, tree)
+        tree.add(3, 30, 30)
+        self.assertEqual(len(tree), 1)
+
+    def test_matches_linear_scan(self):
+        """ Agree with a linear scan over random datetime intervals """
+        rng = random.Random(42)
+        origin = datetime(2021, 1, 1)
+        intervals = {}
+        tree = IntervalTree()
+        for step in range(2000):
+            key = rng.randrange(300)
+            if rng.random() < 0.2:
+                tree.remove(key)
+                intervals.pop(key, None)
+                continue
+            start = origin + timedelta(days=rng.randrange(365))
+            end = start + timedelta(days=rng.randrange(1, 60))
+            tree.add(key, start, end)
+            intervals[key] = (start, end)
+            if step % 100 == 0:
+                point = origin + timedelta(days=rng.randrange(400))
+                expected = sorted(k for k, (s, e) in intervals.items() if s <= point < e)
+                self.assertEqual(sorted(tree.at(point)), expected)
@@ -0,0 +1,66 @@
+"""
+Test cases for the Promotion title trigram index
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import unittest
+from service.ngrams import TrigramIndex
+
+TITLES = [
+    (1, "Summer Sale"),
+    (2, "Winter sale"),
+    (3, "Sale"),
+    (4, "summer_50%"),
+    (5, "Spring Summer"),
+]
+
+######################################################################
+#  T R I G R A M   I N D E X   T E S T   C A S E S
+######################################################################
+
+
+class TestTrigramIndex(unittest.TestCase):
+    """ Test Cases for TrigramIndex """
+
+    def setUp(self):
+        self.index = TrigramIndex(TITLES)
+
+    def test_prefix(self):
+        """ Find the strings starting with a prefix, shortest first """
+        self.assertEqual(self.index.search("SUM", "prefix"), [4, 1])
+        self.assertEqual(self.index.search("s", "prefix"), [3, 4, 1, 5])
+        self.assertEqual(self.index.search("summer s", "prefix"), [1])
+        self.assertEqual(self.index.search("sale", "prefix", limit=1), [3])
+        self.assertEqual(self.index.search("autumn", "prefix"), [])
+
+    def test_substring(self):
+        """ Find the strings containing a text, earliest match first """
+        self.assertEqual(self.index.search("sale", "substring"), [3, 1, 2])
+        self.assertEqual(self.index.search("_50%", "substring"), [4])
+        self.assertEqual(self.index.search("er", "substring"), [4, 1, 2, 5])
+        self.assertEqual(self.index.search("mer s", "substring"), [1])
+
+    def test_fuzzy(self):
+        """ Find the strings similar to a misspelt text, most similar first """
+        self.assertEqual(self.index.search("sumer sale", "fuzzy")[0], 1)
+        self.assertEqual(self.index.search("wintr sale", "fuzzy")[0], 2)
+        self.assertEqual(self.index.search("summer", "fuzzy", threshold=0.9), [])
+        self.assertEqual(self.index.search("xyz", "fuzzy"), [])
+
+    def test_add_and_remove(self):
+        """ Add, replace and remove strings one at a time """
+        self.index.add(6, "Autumn Sale")
+        self.assertEqual(self.index.search("autumn", "prefix"), [6])
+        self.index.add(6, "Fall Sale")
+        self.assertEqual(self.index.search("autumn", "prefix"), [])
+        self.assertEqual(self.index.search("fall", "prefix"), [6])
+        self.index.remove(6)
+        self.index.remove(6)
+        self.assertNotIn(6, self.index)
+        self.assertEqual(len(self.index), len(TITLES))
+        self.assertEqual(self.index.search("fall", "substring"), [])
+
+    def test_unknown_mode(self):
+        """ Refuse an unknown search mode """
+        self.assertRaises(ValueError, self.index.search, "sale", "regex")
@@ -0,0 +1,42 @@
+"""
+Test cases for the connection pool settings
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import unittest
+from service.pool import TimedQueuePool, engine_options
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+
+
+class TestEngineOptions(unittest.TestCase):
+    """ Test Cases for engine_options """
+
+    def test_postgres_options(self):
+        """ Build pool and statement timeout options for PostgreSQL """
+        options = engine_options({
+            "SQLALCHEMY_DATABASE_URI": "postgresql://localhost/db",
+            "DB_POOL_SIZE": 8,
+            "DB_MAX_OVERFLOW": 2,
+            "DB_POOL_TIMEOUT": 5,
+            "DB_POOL_RECYCLE": 600,
+            "DB_POOL_PRE_PING": True,
+            "DB_STATEMENT_TIMEOUT": 2500,
+        })
+        self.assertIs(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 8)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_timeout"], 5)
+        self.assertEqual(options["pool_recycle"], 600)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"]["options"],
+                         "-c statement_timeout=2500")
+
+    def test_sqlite_options(self):
+        """ Leave SQLite on its default pool """
+        options = engine_options({"SQLALCHEMY_DATABASE_URI": "sqlite://",
+                                  "DB_POOL_SIZE": 8})
+        self.assertEqual(options, {})
@@ -8,13 +8,22 @@ Test cases can be run with the following:
     nosetests --stop tests/test_service.py:TestPromotionServer
 """
 
+import io
+import csv
+import gzip
 import os
+import pstats
+import tempfile
+import json
 import logging
 import unittest
+from datetime import date, datetime
 from urllib.parse import quote_plus
 from service import status  # HTTP Status Codes
-from service.models import db
+from service import compression, encoding, load_extensions, metrics
+from service.models import db, Promotion
 from service.routes import app, init_db
+from service.changes import feed
 from .factories import PromotionFactory
 from dateutil import parser
 
@@ -39,6 +48,7 @@ class TestPromotionServer(unittest.TestCase):
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
+        load_extensions()
         init_db()
 
     @classmethod
@@ -49,6 +59,8 @@ class TestPromotionServer(unittest.TestCase):
         """ Runs before each test """
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        Promotion.changed()
+        Promotion.cache.reset()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -217,6 +229,16 @@ class TestPromotionServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
 
+    def test_activate_deleted_promotion(self):
+        """Activate a cached Promotion another worker deleted"""
+        promotion = self._create_promotions(1)[0]
+        url = "{}/{}".format(BASE_URL, promotion.id)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)  # cached
+        db.engine.execute("DELETE FROM promotion WHERE id = %s", promotion.id)
+        resp = self.app.put(url + "/activate", content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
     def test_deactivate_promotion(self):
         """Deactivate an existing Promotion"""
         # create a promotion to update
@@ -247,6 +269,31 @@ class TestPromotionServer(unittest.TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_patch_promotion(self):
+        """Update some fields of a Promotion"""
+        test_promotion = self._create_promotions(1)[0]
+        url = "{0}/{1}".format(BASE_URL, test_promotion.id)
+        resp = self.app.patch(url, json={"title": "patched"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        patched = resp.get_json()
+        self.assertEqual(patched["title"], "patched")
+        self.assertEqual(patched["promotion_type"], test_promotion.promotion_type)
+        self.assertEqual(self.app.get(url).get_json(), patched)
+        self.assertEqual(self.app.get(url).headers["ETag"], resp.headers["ETag"])
+
+    def test_patch_promotion_bad_request(self):
+        """Update some fields of a Promotion with bad data"""
+        test_promotion = self._create_promotions(1)[0]
+        url = "{0}/{1}".format(BASE_URL, test_promotion.id)
+        resp = self.app.patch(url, json={"color": "red"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch(url, json={"end_date": "someday"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch(url, data="title=x", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.patch("{0}/0".format(BASE_URL), json={"title": "x"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_promotion(self):
         """Delete a Promotion"""
         test_promotion = self._create_promotions(1)[0]
@@ -261,6 +308,27 @@ class TestPromotionServer(unittest.TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_promotions_bulk(self):
+        """Delete many Promotions at once"""
+        promotions = self._create_promotions(6)
+        resp = self.app.delete(BASE_URL, json={"ids": [promotions[0].id, promotions[1].id]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["deleted"], 2)
+        resp = self.app.get("{}/{}".format(BASE_URL, promotions[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.delete(BASE_URL, query_string="end_before=1900-01-01")
+        self.assertEqual(resp.get_json()["deleted"], 0)
+        resp = self.app.delete(BASE_URL, query_string="all=true")
+        self.assertEqual(resp.get_json()["deleted"], 4)
+        self.assertEqual(self.app.get(BASE_URL).get_json(), [])
+
+    def test_delete_promotions_bulk_bad_request(self):
+        """Delete many Promotions without saying which"""
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete(BASE_URL, query_string="end_before=yesterday")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_query_promotion_list_by_promotion_type(self):
         """Query Promotions by promotion_type"""
         promotions = self._create_promotions(10)
@@ -307,6 +375,40 @@ class TestPromotionServer(unittest.TestCase):
             self.assertEqual(promotion["title"], test_title)
             
 
+    def test_search_promotion_list_by_title(self):
+        """ Search Promotions by part of their title """
+        for title in ["Summer Sale", "Winter Sale", "Sale"]:
+            promotion = PromotionFactory()
+            promotion.title = title
+            resp = self.app.post(BASE_URL, json=promotion.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(BASE_URL, query_string="title=sale&title_mode=substring")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["title"] for p in resp.get_json()],
+                         ["Sale", "Summer Sale", "Winter Sale"])
+        resp = self.app.get(BASE_URL, query_string="title=summ&title_mode=prefix&limit=1")
+        self.assertEqual([p["title"] for p in resp.get_json()], ["Summer Sale"])
+        resp = self.app.get(BASE_URL, query_string="title=wintr+sale&title_mode=fuzzy")
+        self.assertEqual(resp.get_json()[0]["title"], "Winter Sale")
+        # past the in-memory index limit fuzzy searches need pg_trgm
+        app.config["TITLE_INDEX_MAX_ROWS"] = 2
+        try:
+            Promotion.changed()
+            resp = self.app.get(BASE_URL, query_string="title=wintr+sale&title_mode=fuzzy")
+            self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        finally:
+            app.config["TITLE_INDEX_MAX_ROWS"] = 50000
+            Promotion.title_index_skipped_until = 0.0
+        # a title without a mode is still an exact match
+        resp = self.app.get(BASE_URL, query_string="title=sale")
+        self.assertEqual(resp.get_json(), [])
+        for query in ["title=sale&title_mode=regex",
+                      "title=sale&title_mode=prefix&sort=title",
+                      "title=sale&title_mode=prefix&after=1",
+                      "title=sale&title_mode=prefix&stream=true"]:
+            resp = self.app.get(BASE_URL, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_query_promotion_list_by_end_date(self):
         """Query Promotions by End Date"""
         promotions = self._create_promotions(10)
@@ -323,3 +425,488 @@ class TestPromotionServer(unittest.TestCase):
             self.assertEqual(parser.parse(promotion["end_date"]).
                             strftime('%Y-%m-%d'),
                              test_end_date)
+
+    def test_get_promotion_stats(self):
+        """ Get the number of Promotions by type, flag and month """
+        promotions = self._create_promotions(10)
+        resp = self.app.get(BASE_URL + "/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["count"], 10)
+        for promotion_type in {p.promotion_type for p in promotions}:
+            self.assertEqual(data["promotion_type"][promotion_type], len(
+                [p for p in promotions if p.promotion_type == promotion_type]))
+        self.assertEqual(data["active"]["true"], len([p for p in promotions if p.active]))
+        self.assertEqual(sum(data["end_date"].values()), 10)
+        self.assertTrue(set(data["start_date"]) <= {"2021-01", "2021-07", "2021-11", "2021-12"})
+        resp = self.app.get(BASE_URL + "/stats", query_string="exact=true")
+        self.assertEqual(resp.get_json(), data)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL + "/stats", query_string="exact=true",
+                            headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.delete("{}/{}".format(BASE_URL, promotions[0].id))
+        resp = self.app.get(BASE_URL + "/stats", headers={"If-None-Match": etag})
+        self.assertEqual(resp.get_json()["count"], 9)
+
+    def test_stream_promotion_changes(self):
+        """ Stream the changes to Promotions as Server-Sent Events """
+        promotions = self._create_promotions(2)
+        feed.load()  # forget the change log of the last test
+        app.config["CHANGES_STREAM_TIMEOUT"] = 0  # send what there is and end
+        try:
+            resp = self.app.get(BASE_URL + "/changes", query_string="after=0")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            events = [block.splitlines() for block in
+                      resp.get_data(as_text=True).split("\n\n") if block]
+            self.assertEqual(events[0], ["retry: 1000"])
+            self.assertEqual([event[:2] for event in events[1:]],
+                             [["id: 1", "event: create"], ["id: 2", "event: create"]])
+            data = json.loads(events[2][2][len("data: "):])
+            self.assertEqual(data["promotion_id"], promotions[1].id)
+            self.assertEqual(data["action"], "create")
+            # resume after the last event seen
+            self.app.delete("{}/{}".format(BASE_URL, promotions[0].id))
+            self.assertTrue(feed.wait(2, 5))  # the NOTIFY reached this worker
+            resp = self.app.get(BASE_URL + "/changes", headers={"Last-Event-ID": "2"})
+            self.assertIn("id: 3\nevent: delete\n", resp.get_data(as_text=True))
+            self.assertNotIn("id: 2\n", resp.get_data(as_text=True))
+            resp = self.app.get(BASE_URL + "/changes", headers={"Last-Event-ID": "x"})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            app.config["CHANGES_STREAM_TIMEOUT"] = 300
+
+    def test_poll_promotion_changes(self):
+        """ Long poll the changes to Promotions as JSON """
+        promotions = self._create_promotions(3)
+        feed.load()  # forget the change log of the last test
+        headers = {"Accept": "application/json"}
+        resp = self.app.get(BASE_URL + "/changes", query_string="after=1&limit=1",
+                            headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["last_event_id"], 2)
+        self.assertFalse(data["reset"])
+        self.assertEqual([(change["seq"], change["promotion_id"]) for change in data["changes"]],
+                         [(2, promotions[1].id)])
+        resp = self.app.get(BASE_URL + "/changes", query_string="wait=0", headers=headers)
+        self.assertEqual(resp.get_json(),
+                         {"last_event_id": 3, "reset": False, "changes": []})
+        resp = self.app.get(BASE_URL + "/changes", query_string="after=7&wait=0",
+                            headers=headers)
+        self.assertEqual(resp.get_json(),
+                         {"last_event_id": 3, "reset": True, "changes": []})
+
+    def test_query_promotion_list_by_date_ranges(self):
+        """ Query Promotions starting and ending within date ranges """
+        promotions = self._create_promotions(10)
+        # end_after is inclusive and end_before exclusive
+        expected = [p.id for p in sorted(promotions, key=lambda p: (p.end_date, p.id))
+                    if p.end_date in ["2022-01-01", "2022-07-01"]]
+        resp = self.app.get(BASE_URL, query_string={
+            "end_after": "2022-01-01", "end_before": "2022-11-01", "sort": "end_date"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["id"] for p in resp.get_json()], expected)
+        resp = self.app.get(BASE_URL, query_string="start_after=2100-01-01T00:00:00Z")
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get(BASE_URL, query_string="start_before=2100-01-01&limit=3")
+        self.assertEqual(len(resp.get_json()), 3)
+        resp = self.app.get(BASE_URL, query_string="start_before=next-month")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotion_list_paginated(self):
+        """ Page through the list of Promotions with a cursor """
+        promotions = self._create_promotions(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([p["id"] for p in data],
+                         [promotions[0].id, promotions[1].id])
+        self.assertEqual(resp.headers["X-Next-Cursor"], str(promotions[1].id))
+        self.assertIn('rel="next"', resp.headers["Link"])
+        # follow the cursor to the last page
+        resp = self.app.get(
+            BASE_URL, query_string="limit=2&after={}".format(promotions[3].id))
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["id"], promotions[4].id)
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_promotion_list_bad_limit(self):
+        """ Page through Promotions with an invalid limit """
+        resp = self.app.get(BASE_URL, query_string="limit=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotion_list_streamed(self):
+        """ Stream the list of Promotions """
+        promotions = self._create_promotions(3)
+        test_promotion_type = promotions[0].promotion_type
+        resp = self.app.get(BASE_URL, query_string="stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([p["id"] for p in data], [p.id for p in promotions])
+        # filters still apply to the stream
+        resp = self.app.get(
+            BASE_URL, query_string="stream=true&promotion_type={}".format(
+                quote_plus(test_promotion_type)))
+        for promotion in resp.get_json():
+            self.assertEqual(promotion["promotion_type"], test_promotion_type)
+        # so do limit and after
+        resp = self.app.get(BASE_URL, query_string="stream=true&limit=1&after={}".format(
+            promotions[0].id))
+        self.assertEqual([p["id"] for p in resp.get_json()], [promotions[1].id])
+        resp = self.app.get(BASE_URL, query_string="stream=true&sort=-id&limit=2")
+        self.assertEqual([p["id"] for p in resp.get_json()],
+                         [promotions[2].id, promotions[1].id])
+
+    def test_query_promotion_list_by_many_filters(self):
+        """Query Promotions by several filters at once"""
+        promotions = self._create_promotions(10)
+        test_type = promotions[0].promotion_type
+        test_active = promotions[0].active
+        matches = [promotion for promotion in promotions
+                   if promotion.promotion_type == test_type and promotion.active == test_active]
+        resp = self.app.get(
+            BASE_URL, query_string="promotion_type={}&active={}&sort=-id".format(
+                quote_plus(test_type), test_active)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([p["id"] for p in data],
+                         sorted([p.id for p in matches], reverse=True))
+
+    def test_query_promotion_list_bad_sort(self):
+        """Query Promotions with an invalid sort"""
+        resp = self.app.get(BASE_URL, query_string="sort=nope")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="sort=title&after=1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_cache_stats(self):
+        """ Get the Promotion cache statistics """
+        test_promotion = self._create_promotions(1)[0]
+        for _ in range(3):
+            self.app.get("{0}/{1}".format(BASE_URL, test_promotion.id))
+        resp = self.app.get("/cache")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["misses"], 1)
+        self.assertEqual(data["hits"], 2)
+
+    def test_list_live_promotions(self):
+        """ List the Promotions running at a point in time """
+        promotions = self._create_promotions(5)
+        at = "2021-12-15T00:00:00"
+        live = [p for p in promotions if p.start_date <= at[:10] < p.end_date]
+        resp = self.app.get(BASE_URL + "/live", query_string="at={}".format(at))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([p["id"] for p in data], [p.id for p in live])
+        resp = self.app.get(BASE_URL + "/live",
+                            query_string="at={}&active=true".format(at))
+        self.assertEqual([p["id"] for p in resp.get_json()],
+                         [p.id for p in live if p.active])
+        resp = self.app.get(BASE_URL + "/live", query_string="at=yesterday")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_live_promotions_paged(self):
+        """ Page through the Promotions running at a point in time """
+        for _ in range(3):
+            PromotionFactory(start_date="2021-01-01", end_date="2022-01-01").create()
+        query = "at=2021-06-01T00:00:00&limit=2"
+        resp = self.app.get(BASE_URL + "/live", query_string=query)
+        self.assertEqual([p["id"] for p in resp.get_json()], [1, 2])
+        self.assertEqual(resp.headers["X-Next-Cursor"], "2")
+        self.assertIn("after=2", resp.headers["Link"])
+        resp = self.app.get(BASE_URL + "/live", query_string=query + "&after=2")
+        self.assertEqual([p["id"] for p in resp.get_json()], [3])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_create_promotions_bulk(self):
+        """ Create Promotions in bulk from a JSON array """
+        rows = [PromotionFactory().serialize() for _ in range(5)]
+        rows[1] = {"title": "No Dates"}
+        rows[3]["start_date"] = "not a date"
+        resp = self.app.post(BASE_URL + "/bulk", query_string="batch_size=2",
+                             json=rows, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual(data["failed"], 2)
+        self.assertEqual([r["index"] for r in data["results"]], [0, 1, 2, 3, 4])
+        self.assertIn("error", data["results"][1])
+        self.assertIn("error", data["results"][3])
+        for result in [data["results"][i] for i in [0, 2, 4]]:
+            resp = self.app.get("{}/{}".format(BASE_URL, result["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_create_promotions_bulk_ndjson(self):
+        """ Create Promotions in bulk from newline delimited JSON """
+        rows = [json.dumps(PromotionFactory().serialize()) for _ in range(3)]
+        rows.insert(1, "{not json")
+        resp = self.app.post(BASE_URL + "/bulk", data="\n".join(rows) + "\n",
+                             content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual(data["failed"], 1)
+        self.assertIn("error", data["results"][1])
+
+    def test_create_promotions_bulk_bad_request(self):
+        """ Create Promotions in bulk with a bad body or content type """
+        resp = self.app.post(BASE_URL + "/bulk", json={"title": "x"},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/bulk", data="x", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_activate_promotions_bulk(self):
+        """ Activate and deactivate many Promotions at once """
+        promotions = self._create_promotions(6)
+        ids = [promotion.id for promotion in promotions[:3]]
+        resp = self.app.put(BASE_URL + "/activate", json={"ids": ids},
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        expected = len([p for p in promotions[:3] if not p.active])
+        self.assertEqual(resp.get_json()["updated"], expected)
+        for promotion_id in ids:
+            resp = self.app.get("{}/{}".format(BASE_URL, promotion_id))
+            self.assertEqual(resp.get_json()["active"], True)
+        # deactivate everything that is active through a filter
+        resp = self.app.put(BASE_URL + "/deactivate", query_string="active=true",
+                            json={}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL, query_string="active=true")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_activate_promotions_bulk_bad_request(self):
+        """ Activate many Promotions without ids or filters """
+        resp = self.app.put(BASE_URL + "/activate", json={},
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put(BASE_URL + "/deactivate", json={"ids": ["a"]},
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_promotion_not_modified(self):
+        """ Get a Promotion with a matching If-None-Match """
+        test_promotion = self._create_promotions(1)[0]
+        url = "{}/{}".format(BASE_URL, test_promotion.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(resp.data), 0)
+        # a change gives the promotion a new ETag
+        data = self.app.get(url).get_json()
+        data["title"] = "Changed"
+        self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_promotion_list_not_modified(self):
+        """ Get the list of Promotions with a matching If-None-Match """
+        self._create_promotions(2)
+        resp = self.app.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # any write moves the table version on
+        self._create_promotions(1)
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 3)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_export_promotions(self):
+        """ Export Promotions as NDJSON and CSV """
+        promotions = self._create_promotions(3)
+        resp = self.app.get(BASE_URL + "/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines],
+                         [p.id for p in promotions])
+        resp = self.app.get(BASE_URL + "/export", query_string="format=csv")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]["title"], promotions[0].title)
+        self.assertEqual(rows[0]["start_date"][:10], promotions[0].start_date)
+
+    def test_export_promotions_filtered(self):
+        """ Export only the Promotions matching a filter """
+        promotions = self._create_promotions(6)
+        test_active = promotions[0].active
+        resp = self.app.get(BASE_URL + "/export",
+                            query_string="format=csv&active={}".format(test_active))
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), len([p for p in promotions if p.active == test_active]))
+        resp = self.app.get(BASE_URL + "/export", query_string="format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_pool_stats(self):
+        """ Get the database connection pool statistics """
+        self._create_promotions(1)
+        resp = self.app.get("/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["size"], app.config["DB_POOL_SIZE"])
+        self.assertGreater(data["checkouts"], 0)
+        for key in ["checked_out", "idle", "overflow", "wait_seconds_max"]:
+            self.assertIn(key, data)
+
+    def test_export_metrics(self):
+        """ Export request metrics in the Prometheus format """
+        self._create_promotions(2)
+        self.app.get(BASE_URL)
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        text = resp.get_data(as_text=True)
+        self.assertIn('promotion_http_requests_total{endpoint="list_promotions",'
+                      'method="GET",status="200"}', text)
+        self.assertIn('promotion_http_request_duration_seconds_bucket{'
+                      'endpoint="create_promotions"', text)
+        self.assertIn('promotion_http_request_sql_statements_sum{'
+                      'endpoint="list_promotions"', text)
+        self.assertIn('promotion_http_response_size_bytes_count{'
+                      'endpoint="list_promotions"', text)
+
+    def test_stream_metrics(self):
+        """ Time streamed responses until their body was sent """
+        self._create_promotions(2)
+        labels = {"endpoint": "export_promotions", "method": "GET"}
+
+        def sample(name):
+            return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+        latency = sample("promotion_http_request_duration_seconds_count")
+        statements = sample("promotion_http_request_sql_statements_sum")
+        resp = self.app.get(BASE_URL + "/export", buffered=False)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sample("promotion_http_request_duration_seconds_count"), latency)
+        self.assertEqual(len(resp.get_data().splitlines()), 2)
+        resp.close()
+        self.assertEqual(sample("promotion_http_request_duration_seconds_count"), latency + 1)
+        # the rows were read while the body was sent
+        self.assertGreater(sample("promotion_http_request_sql_statements_sum"), statements)
+
+    def test_profile_request(self):
+        """ Profile a single request on demand """
+        self._create_promotions(2)
+        resp = self.app.get(BASE_URL, headers={"X-Profile": "1"})
+        self.assertNotIn("X-Profile-Summary", resp.headers)
+        app.config["PROFILING_ENABLED"] = True
+        try:
+            resp = self.app.get(BASE_URL)
+            self.assertNotIn("X-Profile-Summary", resp.headers)
+            resp = self.app.get(BASE_URL, headers={"X-Profile": "1"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertIn("list_promotions", resp.headers["X-Profile-Summary"])
+            self.assertIn("count=2", resp.headers["X-Profile-Sql"])
+            with tempfile.TemporaryDirectory() as directory:
+                app.config["PROFILE_DIR"] = directory
+                resp = self.app.get(BASE_URL, headers={"X-Profile": "1"})
+                path = resp.headers["X-Profile-File"]
+                self.assertTrue(pstats.Stats(path).total_calls > 0)
+                with open(path.replace(".prof", ".sql.json")) as sql_file:
+                    self.assertEqual(len(json.load(sql_file)), 2)
+        finally:
+            app.config["PROFILING_ENABLED"] = False
+            app.config["PROFILE_DIR"] = None
+
+    def test_list_promotions_fields(self):
+        """ Get only some fields of the Promotions """
+        promotions = self._create_promotions(3)
+        resp = self.app.get(BASE_URL, query_string="fields=title,id")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data, [{"id": p.id, "title": p.title} for p in promotions])
+        resp = self.app.get(BASE_URL, query_string="fields=active&limit=2")
+        self.assertEqual([sorted(row) for row in resp.get_json()], [["active"]] * 2)
+        resp = self.app.get(BASE_URL, query_string="fields=title&stream=true")
+        self.assertEqual(len(resp.get_json()), 3)
+        resp = self.app.get("{}/{}".format(BASE_URL, promotions[0].id),
+                            query_string="fields=id,end_date")
+        self.assertEqual(sorted(resp.get_json()), ["end_date", "id"])
+        resp = self.app.get(BASE_URL, query_string="fields=title,color")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_dates_are_iso_8601(self):
+        """ Encode dates the same way with and without orjson """
+        promotion = self._create_promotions(1)[0]
+        url = "{}/{}".format(BASE_URL, promotion.id)
+        bodies = []
+        for backend in ["auto", "json"]:
+            app.config["JSON_BACKEND"] = backend
+            try:
+                bodies.append(self.app.get(url).get_data())
+            finally:
+                app.config["JSON_BACKEND"] = "auto"
+        self.assertEqual(bodies[0], bodies[1])
+        data = json.loads(bodies[0])
+        self.assertEqual(data["start_date"], promotion.start_date + "T00:00:00Z")
+        # naive timestamps are UTC, so clients must not read them as local time
+        for backend in ["auto", "json"]:
+            app.config["JSON_BACKEND"] = backend
+            try:
+                self.assertEqual(
+                    encoding.dumps({"at": datetime(2021, 7, 1, 0, 0, 0, 5), "on": date(2021, 7, 1)}),
+                    b'{"at":"2021-07-01T00:00:00.000005Z","on":"2021-07-01"}')
+            finally:
+                app.config["JSON_BACKEND"] = "auto"
+        self.assertEqual(encoding.dumps([{"a": 1}]), b'[{"a":1}]')
+
+    def test_compress_responses(self):
+        """ Compress the responses the client accepts gzip for """
+        # registered last so it runs before the metrics and profiling hooks
+        self.assertIs(app.after_request_funcs[None][-1], compression.compress_response)
+        self._create_promotions(20)
+        headers = {"Accept-Encoding": "gzip"}
+        resp = self.app.get(BASE_URL)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        plain = resp.get_data()
+        resp = self.app.get(BASE_URL, headers=headers)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertTrue(resp.headers["ETag"].startswith("W/"))
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+        # small responses are not worth it
+        resp = self.app.get(BASE_URL, query_string="limit=1", headers=headers)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        # streams are compressed as they are sent
+        resp = self.app.get(BASE_URL, query_string="stream=true", headers=headers)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        data = json.loads(gzip.decompress(resp.get_data()))
+        self.assertEqual(len(data), 20)
+
+    def test_send_precompressed_static_file(self):
+        """ Send the .gz copy of a static file """
+        runner = app.test_cli_runner()
+        path = os.path.join(app.static_folder, "js", "rest_api.js")
+        result = runner.invoke(args=["compress-static"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(os.path.isfile(path + ".gz"))
+        resp = self.app.get("/static/js/rest_api.js")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        plain, mimetype = resp.get_data(), resp.mimetype
+        resp.close()
+        resp = self.app.get("/static/js/rest_api.js", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, mimetype)
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+        resp.close()
+        # a copy older than the file it was made from is not sent
+        os.utime(path + ".gz", (0, 0))
+        resp = self.app.get("/static/js/rest_api.js", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()